@@ -1,18 +1,19 @@
 import streamlit as st
-import yt_dlp
 import os
-import subprocess
-import json
-import tempfile
-from pathlib import Path
-import time
-import re
 from datetime import datetime
-import sys
 import platform
-import requests
-import zipfile
-import shutil
+import logging
+import uuid
+from collections import OrderedDict
+
+from core import (
+    BudgetSelector, DeliveryServer, DownloadJob, DownloadJobManager, FFmpegManager, HistoryStore, HostRateLimiter,
+    MetadataCache, PostProcessStage, Prefetcher, ResultStore, ScratchStore,
+    StreamingZipPackager, ThumbnailCache, YouTubeDownloader, YoutubeDLPool, metrics, same_origin
+)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger('yt_downloader')
 
 # Set page config
 st.set_page_config(
@@ -86,295 +87,114 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-class FFmpegManager:
-    """Manage FFmpeg installation for Streamlit Cloud"""
-    
-    @staticmethod
-    def get_ffmpeg_path():
-        """Get FFmpeg path, install if needed"""
-        # Check if ffmpeg is already available in system
-        try:
-            result = subprocess.run(['ffmpeg', '-version'], 
-                                 capture_output=True, text=True, timeout=10)
-            if result.returncode == 0:
-                return 'ffmpeg'
-        except:
-            pass
-        
-        # For Streamlit Cloud, try to use pre-installed or install
-        possible_paths = [
-            '/usr/bin/ffmpeg',
-            '/usr/local/bin/ffmpeg',
-            './ffmpeg/ffmpeg',
-            './ffmpeg'
-        ]
-        
-        for path in possible_paths:
-            if os.path.exists(path):
-                return path
-        
-        # If not found, return None and handle gracefully
-        return None
-    
-    @staticmethod
-    def setup_ffmpeg():
-        """Setup FFmpeg for the application"""
-        ffmpeg_path = FFmpegManager.get_ffmpeg_path()
-        
-        if ffmpeg_path:
-            os.environ['FFMPEG_BINARY'] = ffmpeg_path
-            return True
-        else:
-            st.warning("⚠️ FFmpeg not found. Some features may be limited.")
-            return False
+@st.cache_resource
+def get_metadata_cache():
+    """Shared metadata cache for all sessions, warmed from the history store"""
+    history = get_history_store()
+    cache = MetadataCache(persist=history)
+    history.warm_metadata(cache)
+    metrics.register('info_cache', cache.stats)
+    return cache
+
+@st.cache_resource
+def get_delivery_server():
+    """Shared delivery endpoint for all sessions"""
+    return DeliveryServer(
+        host=os.environ.get('YTDL_DELIVERY_HOST', '127.0.0.1'),
+        port=int(os.environ.get('YTDL_DELIVERY_PORT', '8502')),
+        base_url=os.environ.get('YTDL_DELIVERY_URL'),
+        metrics=metrics
+    )
+
+@st.cache_resource
+def get_scratch_store():
+    """Shared scratch store for all sessions"""
+    store = ScratchStore(
+        root=os.environ.get('YTDL_SCRATCH_DIR'),
+        quota_bytes=int(os.environ.get('YTDL_SCRATCH_QUOTA_MB', '2048')) * 1024 * 1024,
+        max_age=int(os.environ.get('YTDL_SCRATCH_MAX_AGE', '3600'))
+    )
+    metrics.register('scratch', store.stats)
+    return store
+
+@st.cache_resource
+def get_result_store():
+    """Shared result store, kept next to the scratch runs so it survives restarts"""
+    store = ResultStore(
+        root=get_scratch_store().root / 'results',
+        max_bytes=int(os.environ.get('YTDL_RESULT_CACHE_MB', '1024')) * 1024 * 1024
+    )
+    get_history_store().warm_results(store)
+    metrics.register('result_cache', store.stats)
+    return store
+
+@st.cache_resource
+def get_budget_selector():
+    """Shared format selector, learning throughput from every session's downloads"""
+    selector = BudgetSelector(history=get_history_store())
+    metrics.register('budget', selector.stats)
+    return selector
+
+@st.cache_resource
+def get_history_store():
+    """Shared download history, kept next to the result store so both survive restarts"""
+    store = HistoryStore(os.environ.get('YTDL_HISTORY_DB') or get_scratch_store().root / 'history.sqlite3')
+    metrics.register('history', store.stats)
+    return store
+
+@st.cache_resource
+def get_prefetcher():
+    """Shared prefetcher and thumbnail cache for all sessions"""
+    thumbnails = ThumbnailCache(
+        root=get_scratch_store().root / 'thumbs',
+        max_bytes=int(os.environ.get('YTDL_THUMB_CACHE_MB', '64')) * 1024 * 1024
+    )
+    metrics.register('thumbnails', thumbnails.stats)
+    return Prefetcher(get_metadata_cache(), thumbnails, ydl_pool=get_ydl_pool())
 
 # Initialize session state
 def init_session_state():
-    if 'download_history' not in st.session_state:
-        st.session_state.download_history = []
     if 'current_download' not in st.session_state:
         st.session_state.current_download = None
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex[:12]
+    if 'job_ids' not in st.session_state:
+        st.session_state.job_ids = []
+    if 'history_job_ids' not in st.session_state:
+        # Every job this session submitted, including dismissed ones, for the History tab
+        st.session_state.history_job_ids = []
     if 'ffmpeg_setup' not in st.session_state:
         st.session_state.ffmpeg_setup = FFmpegManager.setup_ffmpeg()
 
-class YouTubeDownloader:
-    def __init__(self, output_path=None):
-        self.output_path = output_path or tempfile.mkdtemp()
-        self.setup_ydl_opts()
-    
-    def setup_ydl_opts(self):
-        """Setup yt-dlp options with HD support"""
-        ffmpeg_path = FFmpegManager.get_ffmpeg_path()
-        
-        self.base_opts = {
-            'quiet': False,
-            'no_warnings': False,
-            'extract_flat': False,
-            # Enable merging of video and audio for HD formats
-            'format': 'best[height<=1080]/best',
-            'merge_output_format': 'mp4',
-            # Prefer free formats
-            'prefer_free_formats': True,
-            # Add headers to avoid some blocks
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            }
-        }
-        
-        if ffmpeg_path:
-            self.base_opts['ffmpeg_location'] = ffmpeg_path
-            # Enable post-processing for format conversion
-            self.base_opts['postprocessors'] = [{
-                'key': 'FFmpegVideoConvertor',
-                'preferedformat': 'mp4',
-            }]
-    
-    def get_video_info(self, url):
-        """Get comprehensive video information"""
-        try:
-            ydl_opts = {**self.base_opts, 'skip_download': True}
-            
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                return info
-        except Exception as e:
-            st.error(f"Error extracting video info: {str(e)}")
-            return None
-    
-    def get_available_formats(self, info):
-        """Get and organize available formats with HD support"""
-        if not info or 'formats' not in info:
-            return {'video': [], 'audio': [], 'combined': []}
-        
-        video_formats = []
-        audio_formats = []
-        combined_formats = []
-        seen_video = set()
-        seen_audio = set()
-        seen_combined = set()
-        
-        for fmt in info['formats']:
-            format_id = fmt.get('format_id', '')
-            height = fmt.get('height', 0)
-            width = fmt.get('width', 0)
-            ext = fmt.get('ext', 'mp4')
-            fps = fmt.get('fps', 30)
-            filesize = fmt.get('filesize') or fmt.get('filesize_approx', 0)
-            vcodec = fmt.get('vcodec', 'unknown')
-            acodec = fmt.get('acodec', 'unknown')
-            
-            # Combined video+audio formats (older/lower quality)
-            if (vcodec != 'none' and acodec != 'none' and height > 0):
-                quality_key = f"{height}p_combined"
-                if quality_key not in seen_combined and height <= 720:  # Usually combined formats are lower quality
-                    combined_formats.append({
-                        'format_id': format_id,
-                        'quality': f"{height}p",
-                        'ext': ext,
-                        'fps': fps,
-                        'filesize': filesize,
-                        'type': 'combined',
-                        'display': f"{height}p Combined ({ext}) - {self.format_bytes(filesize)}"
-                    })
-                    seen_combined.add(quality_key)
-            
-            # High-quality video-only formats
-            elif (vcodec != 'none' and acodec == 'none' and height > 0):
-                quality_key = f"{height}p_video"
-                if quality_key not in seen_video:
-                    # Create format specifier for video+best audio
-                    format_spec = f"{format_id}+bestaudio"
-                    
-                    video_formats.append({
-                        'format_id': format_spec,
-                        'quality': f"{height}p",
-                        'ext': ext,
-                        'fps': fps,
-                        'filesize': filesize,
-                        'vcodec': vcodec[:15],
-                        'type': 'video+audio',
-                        'display': f"{height}p HD ({ext}) - {self.format_bytes(filesize)} + Audio"
-                    })
-                    seen_video.add(quality_key)
-            
-            # Audio-only formats
-            elif (acodec != 'none' and vcodec == 'none'):
-                abr = fmt.get('abr', 0)
-                quality_key = f"{abr}kbps_{ext}"
-                if quality_key not in seen_audio and abr:
-                    audio_formats.append({
-                        'format_id': format_id,
-                        'quality': f"{int(abr)}kbps",
-                        'ext': ext,
-                        'filesize': filesize,
-                        'acodec': acodec[:15],
-                        'type': 'audio',
-                        'display': f"Audio {int(abr)}kbps ({ext}) - {self.format_bytes(filesize)}"
-                    })
-                    seen_audio.add(quality_key)
-        
-        # Sort formats by quality (highest first)
-        video_formats.sort(key=lambda x: int(x['quality'][:-1]), reverse=True)
-        combined_formats.sort(key=lambda x: int(x['quality'][:-1]), reverse=True)
-        audio_formats.sort(key=lambda x: int(x['quality'][:-4]), reverse=True)
-        
-        # Add some preset format options for convenience
-        preset_formats = []
-        if any(fmt for fmt in video_formats if int(fmt['quality'][:-1]) >= 1080):
-            preset_formats.append({
-                'format_id': 'best[height<=1080]',
-                'quality': 'Best ≤1080p',
-                'ext': 'mp4',
-                'type': 'preset',
-                'display': 'Best quality ≤1080p (Recommended)'
-            })
-        
-        preset_formats.append({
-            'format_id': 'best[height<=720]',
-            'quality': 'Best ≤720p',
-            'ext': 'mp4', 
-            'type': 'preset',
-            'display': 'Best quality ≤720p (Fast)'
-        })
-        
-        return {
-            'preset': preset_formats,
-            'video': video_formats[:15],  # Top 15 video formats
-            'combined': combined_formats[:5],  # Top 5 combined formats
-            'audio': audio_formats[:8]    # Top 8 audio formats
-        }
-    
-    def format_bytes(self, bytes_val):
-        """Format bytes to human readable"""
-        if not bytes_val:
-            return "Unknown size"
-        
-        for unit in ['B', 'KB', 'MB', 'GB']:
-            if bytes_val < 1024.0:
-                return f"{bytes_val:.1f} {unit}"
-            bytes_val /= 1024.0
-        return f"{bytes_val:.1f} TB"
-    
-    def download_with_progress(self, url, format_id, custom_name=None):
-        """Download with real progress tracking"""
-        progress_placeholder = st.empty()
-        status_placeholder = st.empty()
-        
-        download_info = {
-            'status': 'starting',
-            'progress': 0,
-            'speed': 0,
-            'eta': 0,
-            'filename': ''
-        }
-        
-        def progress_hook(d):
-            if d['status'] == 'downloading':
-                try:
-                    if d.get('total_bytes'):
-                        progress = (d['downloaded_bytes'] / d['total_bytes']) * 100
-                    elif d.get('total_bytes_estimate'):
-                        progress = (d['downloaded_bytes'] / d['total_bytes_estimate']) * 100
-                    else:
-                        progress = 0
-                    
-                    download_info.update({
-                        'status': 'downloading',
-                        'progress': progress,
-                        'speed': d.get('speed', 0),
-                        'eta': d.get('eta', 0),
-                        'filename': d.get('filename', '')
-                    })
-                    
-                    # Update UI
-                    progress_placeholder.progress(min(progress / 100, 1.0))
-                    
-                    speed_str = f"{download_info['speed']/1024/1024:.1f} MB/s" if download_info['speed'] else "-- MB/s"
-                    eta_str = f"{download_info['eta']}s" if download_info['eta'] else "--s"
-                    
-                    status_placeholder.markdown(f"""
-                    <div class="progress-text">
-                        📥 Downloading: {progress:.1f}% <br>
-                        🚀 Speed: {speed_str} <br>
-                        ⏱️ ETA: {eta_str}
-                    </div>
-                    """, unsafe_allow_html=True)
-                    
-                except Exception as e:
-                    pass
-            
-            elif d['status'] == 'finished':
-                download_info['status'] = 'finished'
-                download_info['filename'] = d.get('filename', '')
-                progress_placeholder.progress(1.0)
-                status_placeholder.success("✅ Download completed!")
-        
-        # Setup download options with better format handling
-        filename_template = '%(title)s.%(ext)s'
-        if custom_name:
-            filename_template = f'{custom_name}.%(ext)s'
-        
-        ydl_opts = {
-            **self.base_opts,
-            'format': format_id,
-            'outtmpl': os.path.join(self.output_path, filename_template),
-            'progress_hooks': [progress_hook],
-            # Ensure we merge video+audio when needed
-            'merge_output_format': 'mp4',
-            # Add post-processors for better compatibility
-            'postprocessors': [{
-                'key': 'FFmpegVideoConvertor',
-                'preferedformat': 'mp4',
-            }] if FFmpegManager.get_ffmpeg_path() else []
-        }
-        
-        try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-            return True, download_info.get('filename', '')
-        except Exception as e:
-            status_placeholder.error(f"❌ Download failed: {str(e)}")
-            return False, str(e)
+@st.cache_resource
+def get_postprocess_stage():
+    """Shared ffmpeg worker pool for all sessions"""
+    workers = int(os.environ.get('YTDL_POSTPROCESS_WORKERS', '0'))
+    stage = PostProcessStage(workers=workers or None)
+    metrics.register('postprocess', stage.stats)
+    return stage
+
+@st.cache_resource
+def get_ydl_pool():
+    """Shared YoutubeDL pool for all sessions"""
+    pool = YoutubeDLPool()
+    metrics.register('ydl_pool', pool.stats)
+    return pool
+
+@st.cache_resource
+def get_job_manager():
+    """Shared download job manager for all sessions"""
+    manager = DownloadJobManager(
+        max_workers=int(os.environ.get('YTDL_MAX_WORKERS', '3')),
+        rate_limiter=HostRateLimiter(float(os.environ.get('YTDL_HOST_INTERVAL', '1.0'))),
+        scratch=get_scratch_store(),
+        results=get_result_store(),
+        postprocess=get_postprocess_stage(),
+        history=get_history_store(),
+        selector=get_budget_selector()
+    )
+    metrics.register('jobs', manager.stats)
+    return manager
 
 def render_header():
     """Render application header"""
@@ -423,6 +243,26 @@ def render_sidebar():
         embed_subs = st.checkbox("Embed Subtitles", help="Embed subtitles into video")
         embed_thumbnail = st.checkbox("Embed Thumbnail", help="Embed thumbnail as cover art")
         
+        st.subheader("⚡ Connection Settings")
+        connections = st.slider(
+            "Parallel connections",
+            min_value=1,
+            max_value=8,
+            value=int(os.environ.get('YTDL_CONNECTIONS', '1')),
+            help="Fetch single-file formats over several byte-range connections (1 = off)"
+        )
+        chunk_size_mb = st.select_slider(
+            "Chunk size (MB)",
+            options=[1, 2, 4, 8, 16, 32],
+            value=8,
+            disabled=connections == 1
+        )
+        parallel_streams = st.checkbox(
+            "Parallel video/audio fetch",
+            value=True,
+            help="Download the video and audio of HD formats at the same time, then merge"
+        )
+        
         # Quality settings
         st.subheader("🎯 Quality Settings")
         max_quality = st.selectbox(
@@ -438,12 +278,93 @@ def render_sidebar():
             help="Preferred video container format"
         )
         
+        selection_mode = st.radio(
+            "Selection Mode",
+            ["Fixed", "Time budget", "Size budget"],
+            horizontal=True,
+            help="Budget modes pick the best quality predicted to finish in time or fit the size, "
+                 "using the throughput measured on recent downloads"
+        )
+        budget_seconds = budget_mb = None
+        if selection_mode == "Time budget":
+            budget_seconds = st.number_input("Finish within (seconds)", min_value=5, value=60, step=5)
+        elif selection_mode == "Size budget":
+            budget_mb = st.number_input("Maximum size (MB)", min_value=1, value=100, step=10)
+        if selection_mode != "Fixed":
+            budget_stats = get_budget_selector().stats()
+            st.caption(
+                f"Planning at {budget_stats['throughput'] / 1024 ** 2:.1f} MB/s + "
+                f"{budget_stats['overhead']:.0f}s overhead ({budget_stats['samples']} samples); "
+                f"budget met {budget_stats['met']}/{budget_stats['budgeted']}"
+            )
+        
         # System info
         st.subheader("🖥️ System Info")
-        ffmpeg_status = "✅ Available" if st.session_state.ffmpeg_setup else "❌ Not Found"
+        ffmpeg_caps = FFmpegManager.probe()
+        ffmpeg_status = f"✅ {ffmpeg_caps['version']}" if ffmpeg_caps['path'] else "❌ Not Found"
         st.write(f"FFmpeg: {ffmpeg_status}")
+        if ffmpeg_caps['hwaccels']:
+            st.write(f"HW accel: {', '.join(ffmpeg_caps['hwaccels'])}")
+        st.write(f"FFmpeg CPU: {metrics.counters().get('ffmpeg_cpu_seconds', 0.0):.1f}s total")
+        
+        timings = metrics.stage_stats()
+        if timings:
+            st.write("Stage p50 / p99:")
+            st.caption("\n\n".join(
+                f"{stage}: {stats['p50']:.2f}s / {stats['p99']:.2f}s ({stats['count']}×)"
+                for stage, stats in timings.items()
+            ))
+        st.caption(f"Metrics: {get_delivery_server().base_url}/metrics")
+        if get_file_server() is None:
+            st.caption("Files can't be saved: run `streamlit run streamlit_app.py` or set YTDL_DELIVERY_URL")
+        if st.button("🔄 Re-check FFmpeg"):
+            st.session_state.ffmpeg_setup = bool(FFmpegManager.probe(refresh=True)['path'])
         st.write(f"Platform: {platform.system()}")
         
+        scratch_stats = get_scratch_store().stats()
+        st.write(
+            f"Scratch disk: {scratch_stats['usage_bytes'] / 1024 ** 2:.0f} / "
+            f"{scratch_stats['quota_bytes'] / 1024 ** 2:.0f} MB"
+        )
+        
+        result_stats = get_result_store().stats()
+        st.write(
+            f"Result cache: {result_stats['entries']} files, "
+            f"{result_stats['bytes'] / 1024 ** 2:.0f} MB, "
+            f"{result_stats['hit_rate']:.0%} hits"
+        )
+        
+        cache_stats = get_metadata_cache().stats()
+        st.write(
+            f"Info cache: {cache_stats['entries']} videos, "
+            f"{cache_stats['bytes'] / 1024:.0f} KB, "
+            f"{cache_stats['hit_rate']:.0%} hits"
+        )
+        
+        pool_stats = get_ydl_pool().stats()
+        st.write(
+            f"YoutubeDL pool: {pool_stats['idle']} warm, "
+            f"{pool_stats['reuse_rate']:.0%} reused"
+        )
+        
+        history_stats = get_history_store().stats()
+        st.write(
+            f"History: {history_stats['jobs']} jobs, "
+            f"{history_stats['bytes'] / 1024:.0f} KB"
+        )
+        
+        thumb_stats = get_prefetcher().thumbnails.stats()
+        st.write(
+            f"Thumbnails: {thumb_stats['entries']} cached, "
+            f"{thumb_stats['bytes'] / 1024:.0f} KB"
+        )
+        
+        stage_stats = get_postprocess_stage().stats()
+        st.write(
+            f"FFmpeg workers: {stage_stats['running']}/{stage_stats['workers']} busy, "
+            f"{stage_stats['queued']} queued"
+        )
+        
         if not st.session_state.ffmpeg_setup:
             st.warning("⚠️ FFmpeg not available. HD video merging may be limited.")
         
@@ -455,41 +376,290 @@ def render_sidebar():
             'embed_subs': embed_subs,
             'embed_thumbnail': embed_thumbnail,
             'max_quality': max_quality,
-            'prefer_format': prefer_format
+            'prefer_format': prefer_format,
+            'budget_seconds': budget_seconds,
+            'budget_mb': budget_mb,
+            'connections': connections,
+            'chunk_size_mb': chunk_size_mb,
+            'parallel_streams': parallel_streams
         }
 
+def new_session_downloader(settings):
+    """Downloader writing into this session's managed scratch directory"""
+    return YouTubeDownloader(
+        output_path=get_scratch_store().session_dir(st.session_state.session_id),
+        metadata_cache=get_metadata_cache(),
+        connections=settings['connections'],
+        chunk_size=settings['chunk_size_mb'] * 1024 * 1024,
+        parallel_streams=settings['parallel_streams'],
+        ydl_pool=get_ydl_pool()
+    )
+
+def download_options(settings):
+    """Per-job options derived from sidebar settings"""
+    if settings['download_type'] == "Audio Only":
+        return {'audio_format': settings['audio_format'], 'audio_quality': settings['audio_quality']}
+    container = YouTubeDownloader.parse_prefer_format(settings['prefer_format'])
+    return {'container': container} if container else {}
+
+def budget_request(settings):
+    """BudgetSelector.select arguments for the sidebar's budget mode, or None in fixed mode"""
+    if settings['budget_seconds'] is None and settings['budget_mb'] is None:
+        return None
+    return {
+        'seconds': settings['budget_seconds'],
+        'megabytes': settings['budget_mb'],
+        'download_type': settings['download_type'],
+        'max_height': YouTubeDownloader.parse_max_quality(settings['max_quality']),
+        'container': YouTubeDownloader.parse_prefer_format(settings['prefer_format']),
+    }
+
+def describe_prediction(prediction):
+    """One-line summary of a budget prediction"""
+    quality = f"{prediction['height']}p" if prediction['height'] else "audio"
+    return (f"{quality} ({prediction['ext']}), ~{prediction['predicted_bytes'] / 1024 ** 2:.1f} MB, "
+            f"~{prediction['predicted_seconds']:.0f}s" + (" incl. re-encode" if prediction.get('transcode') else ""))
+
+YOUTUBE_URL_PREFIXES = ('https://www.youtube.com/', 'https://youtu.be/', 'https://m.youtube.com/')
+
 def render_main_content(settings):
     """Render main content area"""
     col1, col2 = st.columns([2, 1])
     
     with col1:
-        st.header("🔗 Enter Video URL")
+        single_tab, batch_tab, history_tab = st.tabs(["🎬 Single Video", "📚 Batch / Playlist", "📜 History"])
+        with single_tab:
+            render_single_input(settings)
+        with batch_tab:
+            render_batch_input(settings)
+        with history_tab:
+            render_history()
+    
+    with col2:
+        render_download_panel()
+
+def render_single_input(settings):
+    """Render single video URL input"""
+    st.header("🔗 Enter Video URL")
+    
+    url_input = st.text_input(
+        "",
+        placeholder="https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+        help="Paste any YouTube video URL here"
+    )
+    
+    if url_input:
+        if not url_input.startswith(YOUTUBE_URL_PREFIXES):
+            st.error("❌ Please enter a valid YouTube URL")
+            return
         
-        url_input = st.text_input(
-            "",
-            placeholder="https://www.youtube.com/watch?v=dQw4w9WgXcQ",
-            help="Paste any YouTube video URL here"
-        )
+        downloader = new_session_downloader(settings)
         
-        if url_input:
-            if not url_input.startswith(('https://www.youtube.com/', 'https://youtu.be/', 'https://m.youtube.com/')):
-                st.error("❌ Please enter a valid YouTube URL")
-                return
-            
-            downloader = YouTubeDownloader()
-            
-            # Get video info
-            with st.spinner("🔍 Analyzing video..."):
-                video_info = downloader.get_video_info(url_input)
-            
-            if video_info:
-                render_video_info(video_info)
-                render_format_selection(video_info, downloader, settings, url_input)
+        # Get video info
+        with st.spinner("🔍 Analyzing video..."):
+            video_info = downloader.get_video_info(url_input)
+        
+        if video_info:
+            render_video_info(video_info)
+            previous = [row for row in get_history_store().find(url_input, limit=5, job_ids=history_scope())
+                        if row['status'] == DownloadJob.DONE]
+            if previous:
+                st.caption("📜 Downloaded before: " + ", ".join(
+                    f"{row['format_id']} on {datetime.fromtimestamp(row['finished_at']):%Y-%m-%d %H:%M}"
+                    for row in previous))
+            render_format_selection(video_info, downloader, settings, url_input)
+        else:
+            st.error("❌ Could not retrieve video information. Please check the URL.")
+            if downloader.last_error:
+                st.caption(downloader.last_error)
+
+def render_batch_input(settings):
+    """Render batch URL list / playlist input"""
+    st.header("📚 Batch & Playlist Download")
+    
+    urls_text = st.text_area(
+        "Video or playlist URLs (one per line)",
+        placeholder="https://www.youtube.com/watch?v=...\nhttps://www.youtube.com/playlist?list=...",
+        height=150
+    )
+    
+    col_range, col_workers = st.columns(2)
+    with col_range:
+        playlist_items = st.text_input(
+            "Playlist range",
+            placeholder="1-10",
+            help="Items to take from playlists, e.g. 1-10 or 1,3,5-7"
+        )
+    with col_workers:
+        manager = get_job_manager()
+        concurrency = st.slider(
+            "Parallel downloads",
+            min_value=1,
+            max_value=manager.max_workers,
+            value=min(2, manager.max_workers),
+            help="Downloads from this batch running at the same time"
+        )
+    
+    format_spec = YouTubeDownloader.build_format_spec(settings['download_type'], settings['max_quality'])
+    budget = budget_request(settings)
+    if budget:
+        st.caption(f"Format: picked per video for the budget, falling back to `{format_spec}`")
+    else:
+        st.caption(f"Format: `{format_spec}`")
+    
+    col_preview, col_start = st.columns(2)
+    with col_preview:
+        preview_clicked = st.button("🔍 Preview", use_container_width=True)
+    with col_start:
+        start_clicked = st.button("🚀 Start Batch", type="primary", use_container_width=True)
+    
+    urls = [line.strip() for line in urls_text.splitlines() if line.strip()]
+    preview_key = (tuple(urls), playlist_items.strip())
+    preview = st.session_state.get('batch_preview')
+    if preview and preview['key'] != preview_key:
+        # Input changed since the preview was built
+        preview = st.session_state.batch_preview = None
+    
+    if not (preview_clicked or start_clicked):
+        if preview:
+            render_batch_preview(preview['entries'])
+        return
+    
+    if not urls:
+        st.error("❌ Please enter at least one URL")
+        return
+    
+    downloader = new_session_downloader(settings)
+    if preview:
+        entries = preview['entries']
+    else:
+        entries = []
+        with st.spinner("🔍 Expanding playlists..."):
+            for url in urls:
+                if not url.startswith(YOUTUBE_URL_PREFIXES):
+                    st.warning(f"⚠️ Skipped invalid URL: {url}")
+                    continue
+                try:
+                    entries.extend(downloader.expand_entries(url, playlist_items.strip() or None))
+                except Exception as e:
+                    st.warning(f"⚠️ Could not expand {url}: {e}")
+    
+    if not entries:
+        st.error("❌ No downloadable entries found")
+        return
+    
+    if preview_clicked:
+        st.session_state.batch_preview = {'key': preview_key, 'entries': entries}
+        st.session_state.batch_page = 1
+        render_batch_preview(entries)
+        return
+    
+    job_ids = manager.submit_batch(downloader, entries, format_spec, concurrency,
+                                   options=download_options(settings), budget=budget)
+    st.session_state.job_ids.extend(job_ids)
+    st.session_state.history_job_ids.extend(job_ids)
+    st.session_state.batch_preview = None
+    st.toast(f"📥 Queued {len(job_ids)} downloads")
+    st.rerun()
+
+BATCH_PAGE_SIZE = 10
+
+def render_batch_preview(entries):
+    """Paginated list of batch entries; details and thumbnails load in the background"""
+    pages = max(1, -(-len(entries) // BATCH_PAGE_SIZE))
+    st.markdown(f"**{len(entries)} videos**")
+    page = st.number_input("Page", min_value=1, max_value=pages, key='batch_page') if pages > 1 else 1
+    
+    start = (page - 1) * BATCH_PAGE_SIZE
+    shown = entries[start:start + BATCH_PAGE_SIZE]
+    prefetcher = get_prefetcher()
+    # This page first, then the next one so paging forward doesn't wait
+    prefetcher.prefetch_entries(shown)
+    prefetcher.prefetch_entries(entries[start + BATCH_PAGE_SIZE:start + 2 * BATCH_PAGE_SIZE])
+    
+    loading = prefetcher.pending() > 0
+    st.session_state.preview_loading = loading
+    st.fragment(run_every=1.0 if loading else None)(render_preview_rows)(shown)
+
+def render_preview_rows(entries):
+    """Render one page of batch entries from whatever the prefetcher has cached"""
+    prefetcher = get_prefetcher()
+    loading = prefetcher.pending() > 0
+    for entry in entries:
+        col_thumb, col_details = st.columns([1, 3])
+        with col_thumb:
+            thumbnail_path = prefetcher.thumbnail(entry)
+            if thumbnail_path:
+                st.image(thumbnail_path, use_container_width=True)
             else:
-                st.error("❌ Could not retrieve video information. Please check the URL.")
+                st.write("🖼️")
+        with col_details:
+            info = prefetcher.metadata_cache.get(entry['url']) or {}
+            st.markdown(f"**{info.get('title') or entry['title']}**")
+            details = [value for value in (
+                info.get('uploader'),
+                info.get('duration_string'),
+                f"{info['view_count']:,} views" if info.get('view_count') else None,
+            ) if value]
+            st.caption(" · ".join(details) if details
+                       else "⏳ Loading details..." if loading else "Details unavailable")
     
-    with col2:
-        render_download_panel()
+    # Everything arrived: rerun once so polling stops
+    if st.session_state.get('preview_loading') and not loading:
+        st.session_state.preview_loading = False
+        st.rerun()
+
+HISTORY_PAGE_SIZE = 20
+# Show every session's downloads (and their files) in History; only for private, single-user deploys
+SHARED_HISTORY = os.environ.get('YTDL_SHARED_HISTORY', '').lower() in ('1', 'true', 'yes')
+
+def history_scope():
+    """Job IDs history lookups are limited to: this session's, or None for all with SHARED_HISTORY"""
+    return None if SHARED_HISTORY else st.session_state.history_job_ids
+
+def render_history():
+    """Paginated download history from the persistent store, scoped to this session unless shared"""
+    st.header("📜 Download History")
+    history = get_history_store()
+    job_ids = history_scope()
+    
+    query = st.text_input("Find by URL or video ID", placeholder="https://youtu.be/... or dQw4w9WgXcQ")
+    if query.strip():
+        rows = history.find(query.strip(), limit=HISTORY_PAGE_SIZE, job_ids=job_ids)
+    else:
+        status = st.selectbox("Status", ["All", DownloadJob.DONE, DownloadJob.FAILED, DownloadJob.CANCELLED])
+        status = None if status == "All" else status
+        total = history.count(status, job_ids)
+        pages = max(1, -(-total // HISTORY_PAGE_SIZE))
+        page = st.number_input("Page", min_value=1, max_value=pages, key='history_page') if pages > 1 else 1
+        rows = history.page(page, HISTORY_PAGE_SIZE, status, job_ids)
+        if rows:
+            st.caption(f"{total} downloads")
+    
+    if not rows:
+        st.info("No downloads recorded yet")
+        return
+    
+    for row in rows:
+        col_details, col_file = st.columns([3, 1])
+        with col_details:
+            st.markdown(f"**{row['title'] or row['url']}**")
+            details = [
+                datetime.fromtimestamp(row['finished_at']).strftime('%Y-%m-%d %H:%M'),
+                row['format_id'],
+                f"{row['seconds']:.1f}s" if row['seconds'] is not None else None,
+                "cached" if row['cache_hit'] else None,
+                f"sha256 {row['sha256'][:12]}" if row['sha256'] else None,
+                f"🎯 predicted {row['predicted_seconds']:.0f}s" if row['predicted_seconds'] is not None else None,
+            ]
+            st.caption(" · ".join(value for value in details if value))
+            if row['status'] != DownloadJob.DONE:
+                st.caption(f"❌ {row['status']}: {row['error'] or ''}")
+        with col_file:
+            if row['path'] and os.path.exists(row['path']):
+                render_file_button(row['path'], f"💾 {row['size'] / 1024 / 1024:.1f} MB", key=f"history_{row['id']}")
+            elif row['status'] == DownloadJob.DONE:
+                st.caption("File expired")
 
 def render_video_info(info):
     """Render video information card"""
@@ -515,13 +685,12 @@ def render_video_info(info):
             st.write(f"**Description:** {description[:100]}...")
     
     with col_info2:
-        # Thumbnail
-        thumbnail_url = info.get('thumbnail')
-        if thumbnail_url:
-            try:
-                st.image(thumbnail_url, width=250, caption="Video Thumbnail")
-            except:
-                st.write("🖼️ Thumbnail not available")
+        # Thumbnail, fetched and downsized once per video
+        thumbnail_path = get_prefetcher().thumbnail(info, wait=3.0)
+        if thumbnail_path:
+            st.image(thumbnail_path, width=250, caption="Video Thumbnail")
+        else:
+            st.write("🖼️ Thumbnail not available")
     
     st.markdown('</div>', unsafe_allow_html=True)
 
@@ -529,13 +698,22 @@ def render_format_selection(info, downloader, settings, url):
     """Render format selection and download options"""
     st.markdown("### 🎥 Available Formats")
     
-    formats = downloader.get_available_formats(info)
+    formats = downloader.get_available_formats(
+        info,
+        max_height=YouTubeDownloader.parse_max_quality(settings['max_quality']),
+        container=YouTubeDownloader.parse_prefer_format(settings['prefer_format'])
+    )
     
     # Organize formats by type
     if settings['download_type'] == "Audio Only":
-        available_formats = formats['audio']
+        quality_label = "best" if settings['audio_quality'] == 'best' else f"≥{settings['audio_quality']}kbps"
+        available_formats = [{
+            'format_id': 'bestaudio',
+            'type': 'audio-auto',
+            'display': f"Auto: smallest audio stream {quality_label} → {settings['audio_format']}"
+        }] + formats['audio']
         format_type = "Audio"
-        st.info("🎵 Audio-only formats selected")
+        st.info(f"🎵 Audio only, saved as {settings['audio_format']} (no video is downloaded)")
     elif settings['download_type'] == "Video Only":
         available_formats = formats['video']
         format_type = "Video (No Audio)"
@@ -548,6 +726,22 @@ def render_format_selection(info, downloader, settings, url):
         format_type = "Video + Audio"
         st.success("🎬 Video with audio formats")
     
+    budget = budget_request(settings)
+    prediction = get_budget_selector().select(info, **budget) if budget else None
+    if budget and prediction:
+        if prediction['fits']:
+            st.info(f"🎯 Budget pick: {describe_prediction(prediction)} "
+                    f"at {prediction['throughput'] / 1024 ** 2:.1f} MB/s")
+        else:
+            st.warning(f"🎯 Nothing is predicted to fit the budget; smallest option: {describe_prediction(prediction)}")
+        available_formats = [{
+            'format_id': prediction['format_id'],
+            'type': 'budget',
+            'display': f"🎯 Budget pick: {describe_prediction(prediction)}"
+        }] + available_formats
+    elif budget:
+        st.warning("🎯 No format sizes known for this video, choose a format manually")
+    
     if not available_formats:
         st.error("❌ No compatible formats found for the selected type")
         return
@@ -555,3 +749,166 @@ def render_format_selection(info, downloader, settings, url):
     # Format selection with categories
     format_options = []
     format_categories = []
+    for fmt in available_formats:
+        format_options.append(fmt['display'])
+        format_categories.append(fmt['type'])
+    
+    selected_index = st.selectbox(
+        f"Select {format_type} Format",
+        range(len(format_options)),
+        format_func=lambda i: format_options[i]
+    )
+    selected_format = available_formats[selected_index]
+    
+    if st.button("⬇️ Download", type="primary", use_container_width=True):
+        job_id = get_job_manager().submit(
+            downloader, url, selected_format['format_id'],
+            custom_name=settings['custom_name'] or None, info=info,
+            options=download_options(settings),
+            prediction=prediction if selected_format['type'] == 'budget' else None
+        )
+        st.session_state.job_ids.append(job_id)
+        st.session_state.history_job_ids.append(job_id)
+        st.toast("📥 Download queued")
+        st.rerun()
+
+def render_job_status(job):
+    """Render progress for a single job"""
+    st.markdown(f"**{job['title']}**")
+    
+    if job['status'] == DownloadJob.QUEUED:
+        st.write("⏳ Queued")
+    elif job['status'] == DownloadJob.RUNNING and job['phase'] == 'waiting':
+        st.write("🔗 Waiting for an identical download already in progress")
+    elif job['status'] == DownloadJob.RUNNING and job['phase'] == 'processing':
+        st.progress(min(job['progress'] / 100, 1.0))
+        st.write("⚙️ Merging and finalizing...")
+    elif job['status'] == DownloadJob.RUNNING:
+        st.progress(min(job['progress'] / 100, 1.0))
+        speed_str = f"{job['speed']/1024/1024:.1f} MB/s" if job['speed'] else "-- MB/s"
+        eta_str = f"{job['eta']}s" if job['eta'] else "--s"
+        st.markdown(f"""
+        <div class="progress-text">
+            📥 Downloading: {job['progress']:.1f}% <br>
+            🚀 Speed: {speed_str} <br>
+            ⏱️ ETA: {eta_str}
+        </div>
+        """, unsafe_allow_html=True)
+    elif job['status'] == DownloadJob.FAILED:
+        st.markdown(f'<span class="status-error">❌ Failed: {job["error"]}</span>', unsafe_allow_html=True)
+    elif job['status'] == DownloadJob.CANCELLED:
+        st.write("🚫 Cancelled")
+
+def render_active_jobs():
+    """Poll and render jobs that are still queued or running"""
+    manager = get_job_manager()
+    jobs = manager.list(st.session_state.job_ids)
+    active = [job for job in jobs if job['status'] not in DownloadJob.FINAL_STATES]
+    
+    for job in active:
+        render_job_status(job)
+        if st.button("Cancel", key=f"cancel_{job['id']}"):
+            manager.cancel(job['id'])
+            # Still running for other sessions: just stop following it here
+            if manager.get(job['id'])['status'] not in DownloadJob.FINAL_STATES:
+                st.session_state.job_ids.remove(job['id'])
+    
+    # A job finished since the last full run: rerun so the panel shows its result
+    if len(active) < st.session_state.get('active_job_count', 0):
+        st.rerun()
+    st.session_state.active_job_count = len(active)
+
+def get_file_server():
+    """Where finished files are streamed from: the public delivery URL, the app's own origin, or nowhere"""
+    if os.environ.get('YTDL_DELIVERY_URL'):
+        return get_delivery_server()
+    return same_origin if same_origin.mounted else None
+
+def render_file_button(path, label, filename=None, key=None):
+    """Save button for a finished file, streamed from disk whatever its size"""
+    server = get_file_server()
+    if server is None:
+        st.caption("Run `streamlit run streamlit_app.py` or set YTDL_DELIVERY_URL to save files")
+        return
+    st.link_button(label, server.publish_file(path, filename=filename), key=key, use_container_width=True)
+
+def render_download_panel():
+    """Render the session's downloads, polling while any are active"""
+    st.header("📥 Downloads")
+    
+    manager = get_job_manager()
+    jobs = manager.list(st.session_state.job_ids)
+    st.session_state.job_ids = [job['id'] for job in jobs]
+    
+    if not jobs:
+        st.info("No downloads yet")
+        return
+    
+    # Per-batch summary; individual entries are listed below
+    batches = OrderedDict()
+    for job in jobs:
+        if job['batch_id']:
+            batches.setdefault(job['batch_id'], []).append(job['status'])
+    for batch_id, statuses in batches.items():
+        st.caption(
+            f"Batch {batch_id[:6]}: {statuses.count(DownloadJob.DONE)}/{len(statuses)} done, "
+            f"{statuses.count(DownloadJob.FAILED)} failed, "
+            f"{sum(1 for status in statuses if status not in DownloadJob.FINAL_STATES)} pending"
+        )
+    
+    active_count = sum(1 for job in jobs if job['status'] not in DownloadJob.FINAL_STATES)
+    st.session_state.active_job_count = active_count
+    st.fragment(run_every=1.0 if active_count else None)(render_active_jobs)()
+    
+    finished_files = [job['filename'] for job in jobs
+                      if job['status'] == DownloadJob.DONE and os.path.exists(job['filename'])]
+    zip_label = f"📦 Download all as ZIP ({len(finished_files)} files)"
+    zip_name = f"youtube_downloads_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    if len(finished_files) > 1 and get_file_server() is not None:
+        # Reuse the link until the set of finished files changes
+        zip_key = tuple(finished_files)
+        if st.session_state.get('zip_link', (None, None))[0] != zip_key:
+            # Packed chunk by chunk as the browser reads it, never held whole
+            zip_url = get_file_server().publish_stream(
+                zip_name,
+                lambda: iter(StreamingZipPackager(finished_files)),
+                content_type='application/zip'
+            )
+            st.session_state.zip_link = (zip_key, zip_url)
+        zip_url = st.session_state.zip_link[1]
+        st.link_button(zip_label, zip_url, use_container_width=True)
+    
+    for job in reversed(jobs):
+        if job['status'] not in DownloadJob.FINAL_STATES:
+            continue
+        
+        if job['status'] == DownloadJob.DONE and os.path.exists(job['filename']):
+            st.markdown(f"**{job['title']}**")
+            completed_label = "✅ Completed (cached)" if job['cache_hit'] else "✅ Completed"
+            st.markdown(f'<span class="status-completed">{completed_label}</span>', unsafe_allow_html=True)
+            if job['spans']:
+                st.caption("⏱️ " + " · ".join(f"{span['stage']} {span['seconds']:.1f}s" for span in job['spans']))
+            if job['prediction'] and not job['cache_hit']:
+                outcome = BudgetSelector.outcome(job)
+                st.caption(
+                    f"🎯 {'✅' if outcome['met'] else '⚠️'} Predicted {job['prediction']['predicted_seconds']:.0f}s / "
+                    f"{job['prediction']['predicted_bytes'] / 1024 ** 2:.1f} MB, "
+                    f"actual {outcome['seconds']:.0f}s / {outcome['bytes'] / 1024 ** 2:.1f} MB"
+                )
+            render_file_button(
+                job['filename'],
+                f"💾 Save File ({os.path.getsize(job['filename']) / 1024 / 1024:.1f} MB)",
+                filename=job['download_name'],
+                key=f"save_{job['id']}"
+            )
+        else:
+            render_job_status(job)
+
+def main():
+    init_session_state()
+    render_header()
+    settings = render_sidebar()
+    render_main_content(settings)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""Benchmark the download pipeline against a local stand-in media server
+
+Generates test media with ffmpeg, serves it over HTTP on 127.0.0.1 and runs
+info extraction (yt-dlp generic extractor), format ranking, download,
+merge, remux and ZIP packaging at one or more concurrency levels. No
+network access is needed.
+
+    python bench.py --concurrency 1,4 --iterations 8 --output bench.json
+    python bench.py --baseline bench.json   # exit 1 on a p50 regression
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import yt_dlp
+
+from core import (DeliveryServer, FFmpegManager, FormatIndex, PostProcessStage,
+                 ScratchStore, StreamingZipPackager, YouTubeDownloader, YoutubeDLPool)
+
+logger = logging.getLogger('yt_downloader.bench')
+
+STAGES = ('info', 'formats', 'download', 'merge', 'remux', 'package')
+
+# Codecs of the generated media; the generic extractor cannot see them
+MEDIA = {
+    'progressive': {'ext': 'mp4', 'vcodec': 'avc1.64001f', 'acodec': 'mp4a.40.2'},
+    'video': {'ext': 'mp4', 'vcodec': 'avc1.64001f', 'acodec': 'none'},
+    'audio': {'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a.40.2'},
+}
+
+
+def generate_media(directory, duration, height):
+    """Encode a progressive clip plus its video-only and audio-only halves; return paths by name"""
+    ffmpeg = FFmpegManager.get_ffmpeg_path()
+    width = height * 16 // 9
+    paths = {name: os.path.join(directory, f"{name}.{spec['ext']}") for name, spec in MEDIA.items()}
+    commands = [
+        ['-f', 'lavfi', '-i', f"testsrc2=size={width}x{height}:rate=30:duration={duration}",
+         '-f', 'lavfi', '-i', f"sine=frequency=440:duration={duration}",
+         '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-c:a', 'aac',
+         '-movflags', '+faststart', paths['progressive']],
+        ['-i', paths['progressive'], '-map', '0:v:0', '-c', 'copy', paths['video']],
+        ['-i', paths['progressive'], '-map', '0:a:0', '-c', 'copy', paths['audio']],
+    ]
+    for args in commands:
+        subprocess.run([ffmpeg, '-hide_banner', '-loglevel', 'error', '-y'] + args, check=True)
+    return paths
+
+
+def synthetic_info(info, urls, sizes, extra_formats=40):
+    """Give the generic extractor's result YouTube-like format lists, pointing at the local server"""
+    formats = []
+    for name, spec in MEDIA.items():
+        formats.append({
+            'format_id': name,
+            'url': urls[name],
+            'protocol': 'http',
+            'ext': spec['ext'],
+            'vcodec': spec['vcodec'],
+            'acodec': spec['acodec'],
+            'height': None if spec['vcodec'] == 'none' else 720,
+            'width': None if spec['vcodec'] == 'none' else 1280,
+            'tbr': 1000 if name == 'progressive' else 900 if name == 'video' else 128,
+            'abr': 128 if spec['acodec'] != 'none' else None,
+            'filesize': sizes[name],
+        })
+    # Unreachable decoys so ranking works on a realistically long list
+    heights = (144, 240, 360, 480)
+    for i in range(extra_formats):
+        formats.append({
+            'format_id': f"decoy{i}",
+            'url': f"{urls['video']}?decoy={i}",
+            'protocol': 'https',
+            'ext': 'webm' if i % 2 else 'mp4',
+            'vcodec': 'vp9' if i % 2 else 'avc1.4d401e',
+            'acodec': 'none',
+            'height': heights[i % len(heights)],
+            'tbr': 100 + i,
+            'filesize': 1000 + i,
+        })
+    return {**info, 'formats': formats}
+
+
+class ResourceSampler:
+    """Track peak RSS of this process and peak disk usage of a directory in the background"""
+
+    def __init__(self, directory, interval=0.05):
+        self.directory = directory
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='bench-sampler', daemon=True)
+
+    @staticmethod
+    def rss_bytes():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            # ru_maxrss is in KB on Linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_rss = max(self.peak_rss, self.rss_bytes())
+            self.peak_disk = max(self.peak_disk, ScratchStore.dir_size(self.directory))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, -(-len(ordered) * pct // 100) - 1))
+    return ordered[int(rank)]
+
+
+def run_pipeline(server_urls, sizes, workdir, ydl_pool, connections):
+    """One pass over every stage; return per-stage seconds and bytes moved"""
+    timings = {}
+    output_dir = tempfile.mkdtemp(dir=workdir)
+    # No metadata cache: every pass pays for a real extraction
+    downloader = YouTubeDownloader(output_path=output_dir, connections=connections, ydl_pool=ydl_pool)
+    downloader.base_opts.update({'quiet': True, 'no_warnings': True, 'noprogress': True})
+
+    def timed(stage, fn, *args, **kwargs):
+        started = time.perf_counter()
+        result = fn(*args, **kwargs)
+        timings[stage] = time.perf_counter() - started
+        return result
+
+    url = server_urls['progressive']
+    info = timed('info', downloader.get_video_info, url)
+    if not info:
+        raise RuntimeError(f"info extraction failed for {url}")
+    info = synthetic_info(info, server_urls, sizes)
+
+    def rank():
+        formats = downloader.get_available_formats(info, max_height=1080, container='mp4')
+        FormatIndex.for_info(info).best_per_height(kind='video', max_height=1080, container='mp4')
+        return formats
+    timed('formats', rank)
+
+    success, progressive, task = timed('download', downloader.fetch, url, 'progressive', info=info)
+    if not success:
+        raise RuntimeError(f"download failed: {progressive}")
+    if task:
+        progressive = PostProcessStage.execute(task)
+
+    def merge():
+        ok, result, merge_task = downloader.fetch(url, 'video+audio', info=info,
+                                                  output_path=tempfile.mkdtemp(dir=output_dir))
+        if not ok:
+            raise RuntimeError(f"merge download failed: {result}")
+        return PostProcessStage.execute(merge_task) if merge_task else result
+    merged = timed('merge', merge)
+
+    remux_task = {
+        'op': 'remux',
+        'inputs': [merged],
+        'output': os.path.splitext(merged)[0] + '.remux.mp4',
+        'target': 'mp4',
+        'reason': 'benchmark',
+    }
+    remuxed = timed('remux', PostProcessStage.execute, remux_task)
+
+    def package():
+        return sum(len(chunk) for chunk in StreamingZipPackager([progressive, remuxed]))
+    zip_bytes = timed('package', package)
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    moved = sizes['progressive'] + sizes['video'] + sizes['audio'] + zip_bytes
+    return timings, moved
+
+
+def run_level(concurrency, iterations, server_urls, sizes, workdir, ydl_pool, connections):
+    """Run `iterations` pipelines with `concurrency` in flight; return the level's report"""
+    per_stage = {stage: [] for stage in STAGES}
+    totals = []
+    failures = 0
+    moved = 0
+
+    def one(_):
+        started = time.perf_counter()
+        timings, nbytes = run_pipeline(server_urls, sizes, workdir, ydl_pool, connections)
+        return timings, nbytes, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ResourceSampler(workdir) as sampler:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='bench') as pool:
+            futures = [pool.submit(one, i) for i in range(iterations)]
+            for future in futures:
+                try:
+                    timings, nbytes, total = future.result()
+                except Exception as e:
+                    failures += 1
+                    logger.warning("Pipeline failed: %s", e)
+                    continue
+                for stage, seconds in timings.items():
+                    per_stage[stage].append(seconds)
+                totals.append(total)
+                moved += nbytes
+    wall = time.perf_counter() - started
+
+    return {
+        'concurrency': concurrency,
+        'iterations': iterations,
+        'failures': failures,
+        'wall_seconds': wall,
+        'pipelines_per_second': len(totals) / wall if wall else 0.0,
+        'throughput_mb_per_second': moved / wall / 1024 ** 2 if wall else 0.0,
+        'peak_rss_mb': sampler.peak_rss / 1024 ** 2,
+        'peak_disk_mb': sampler.peak_disk / 1024 ** 2,
+        'stages': {
+            stage: {
+                'count': len(values),
+                'p50_ms': percentile(values, 50) * 1000 if values else None,
+                'p99_ms': percentile(values, 99) * 1000 if values else None,
+            }
+            for stage, values in list(per_stage.items()) + [('total', totals)]
+        },
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print p50 changes against a baseline run; return the regressions beyond tolerance"""
+    regressions = []
+    previous = {level['concurrency']: level for level in baseline.get('levels', [])}
+    for level in results['levels']:
+        before = previous.get(level['concurrency'])
+        if not before:
+            continue
+        for stage, now in level['stages'].items():
+            old = before['stages'].get(stage, {}).get('p50_ms')
+            if not old or now['p50_ms'] is None:
+                continue
+            change = now['p50_ms'] / old - 1
+            print(f"  c={level['concurrency']:<3} {stage:<9} p50 {old:9.1f} -> {now['p50_ms']:9.1f} ms "
+                  f"({change:+.0%})")
+            if change > tolerance:
+                regressions.append((level['concurrency'], stage, change))
+    return regressions
+
+
+def print_report(results):
+    for level in results['levels']:
+        print(f"\nconcurrency={level['concurrency']}  iterations={level['iterations']}  "
+              f"failures={level['failures']}  wall={level['wall_seconds']:.2f}s")
+        print(f"  throughput {level['throughput_mb_per_second']:.1f} MB/s, "
+              f"{level['pipelines_per_second']:.2f} pipelines/s, "
+              f"peak RSS {level['peak_rss_mb']:.0f} MB, peak disk {level['peak_disk_mb']:.1f} MB")
+        for stage, stats in level['stages'].items():
+            if stats['count']:
+                print(f"  {stage:<9} p50 {stats['p50_ms']:9.1f} ms   p99 {stats['p99_ms']:9.1f} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', default='1,4',
+                        help="Comma-separated concurrency levels (default: 1,4)")
+    parser.add_argument('--iterations', type=int, default=8, help="Pipelines per level (default: 8)")
+    parser.add_argument('--duration', type=int, default=10, help="Test clip length in seconds")
+    parser.add_argument('--height', type=int, default=720, help="Test clip height in pixels")
+    parser.add_argument('--connections', type=int, default=4, help="Range connections per stream")
+    parser.add_argument('--output', help="Write JSON results to this file")
+    parser.add_argument('--baseline', help="Earlier JSON results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Allowed p50 slowdown against the baseline (default: 0.25)")
+    parser.add_argument('--verbose', action='store_true', help="Keep the app's per-download logging")
+    args = parser.parse_args(argv)
+    if not args.verbose:
+        logging.getLogger('yt_downloader').setLevel(logging.WARNING)
+
+    if not FFmpegManager.get_ffmpeg_path():
+        parser.error("ffmpeg is required to generate test media")
+    levels = [int(level) for level in args.concurrency.split(',') if level.strip()]
+
+    workdir = tempfile.mkdtemp(prefix='yt-downloader-bench-')
+    try:
+        media_dir = os.path.join(workdir, 'media')
+        os.makedirs(media_dir)
+        paths = generate_media(media_dir, args.duration, args.height)
+        sizes = {name: os.path.getsize(path) for name, path in paths.items()}
+
+        server = DeliveryServer(host='127.0.0.1', port=0)
+        server_urls = {name: server.publish_file(path) for name, path in paths.items()}
+        ydl_pool = YoutubeDLPool()
+
+        results = {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'yt_dlp': yt_dlp.version.__version__,
+                'ffmpeg': FFmpegManager.probe()['version'],
+            },
+            'parameters': {
+                'duration': args.duration,
+                'height': args.height,
+                'connections': args.connections,
+                'media_bytes': sizes,
+            },
+            'levels': [],
+        }
+        for concurrency in levels:
+            results['levels'].append(run_level(concurrency, args.iterations, server_urls, sizes,
+                                               workdir, ydl_pool, args.connections))
+        results['peak_child_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nCompared with {args.baseline}:")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} stage(s) slower than the {args.tolerance:.0%} tolerance")
+            return 1
+    return 1 if any(level['failures'] for level in results['levels']) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+"""Headless downloads for cron jobs, workers and scripts
+
+    python cli.py download URL [URL ...] -o downloads/
+    python cli.py download -i urls.txt --audio mp3 --audio-quality 192
+    cat urls.txt | python cli.py download
+    python cli.py info URL
+
+Prints one JSON object per URL on stdout, as each finishes. The same
+functions are importable:
+
+    from cli import download
+    for result in download(['https://youtu.be/...'], output_dir='downloads'):
+        print(result['path'])
+
+Streamlit is never imported, and yt-dlp only once a URL is processed.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from core import FFmpegManager, MetadataCache, YouTubeDownloader, YoutubeDLPool
+
+logger = logging.getLogger('yt_downloader.cli')
+
+# Keep yt-dlp's console output off stdout, which carries the JSON results
+QUIET_OPTS = {'quiet': True, 'no_warnings': True, 'noprogress': True}
+
+
+def read_urls(urls=None, input_path=None, stdin=None):
+    """URLs from arguments, a file ("-" for stdin), or piped stdin; blank lines and # comments skipped"""
+    stdin = stdin or sys.stdin
+    lines = list(urls or [])
+    if input_path == '-' or (not lines and not input_path and not stdin.isatty()):
+        lines += stdin.read().splitlines()
+    elif input_path:
+        with open(input_path) as f:
+            lines += f.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.lstrip().startswith('#')]
+
+
+def new_downloader(output_dir='.', connections=1):
+    """A YouTubeDownloader with its own metadata cache and YoutubeDL pool, silent on stdout"""
+    downloader = YouTubeDownloader(
+        output_path=os.path.abspath(output_dir),
+        metadata_cache=MetadataCache(),
+        connections=connections,
+        ydl_pool=YoutubeDLPool()
+    )
+    downloader.base_opts.update(QUIET_OPTS)
+    return downloader
+
+
+def info(urls, downloader=None):
+    """Yield slimmed metadata for each URL, without download URLs or headers"""
+    downloader = downloader or new_downloader()
+    for url in urls:
+        video_info = downloader.get_video_info(url)
+        if not video_info:
+            yield {'url': url, 'ok': False, 'error': downloader.last_error}
+            continue
+        slim = MetadataCache.slim_info(video_info)
+        slim['formats'] = [{key: value for key, value in fmt.items() if key not in ('url', 'http_headers')}
+                           for fmt in slim['formats']]
+        yield {'url': url, 'ok': True, **slim}
+
+
+def download(urls, output_dir='.', format_spec=None, max_height=None, audio_format=None,
+             audio_quality='best', playlist_items=None, connections=1, workers=2, downloader=None):
+    """Download every URL (playlists expanded), yielding one result dict per video as it finishes"""
+    downloader = downloader or new_downloader(output_dir, connections)
+    options = {'audio_format': audio_format, 'audio_quality': audio_quality} if audio_format else {}
+    if not format_spec:
+        format_spec = YouTubeDownloader.build_format_spec(
+            "Audio Only" if audio_format else "Video + Audio",
+            f"{max_height}p" if max_height else None
+        )
+
+    entries = []
+    for url in urls:
+        try:
+            entries.extend(downloader.expand_entries(url, playlist_items))
+        except Exception as e:
+            yield {'url': url, 'ok': False, 'error': f"could not expand: {e}"}
+
+    def run(entry):
+        started = time.time()
+        try:
+            ok, result = downloader.download(entry['url'], format_spec, options=options)
+        except Exception as e:
+            ok, result = False, str(e)
+        record = {
+            'url': entry['url'],
+            'title': entry.get('title'),
+            'format': format_spec,
+            'ok': ok,
+            'seconds': round(time.time() - started, 3),
+        }
+        if ok:
+            record.update(path=result, size=os.path.getsize(result) if os.path.isfile(result) else None)
+        else:
+            record['error'] = result
+        return record
+
+    # The same video listed twice would race on one output file
+    unique = list({entry['url']: entry for entry in entries}.values())
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='cli') as pool:
+        for future in as_completed([pool.submit(run, entry) for entry in unique]):
+            yield future.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless YouTube downloader")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Log progress to stderr")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    for name, help_text in (('download', "Download videos"), ('info', "Print video metadata")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('urls', nargs='*', help="Video or playlist URLs")
+        command.add_argument('-i', '--input', help="File with one URL per line, or - for stdin")
+
+    download_parser = commands.choices['download']
+    download_parser.add_argument('-o', '--output-dir', default='.', help="Where finished files go")
+    download_parser.add_argument('-f', '--format', help="yt-dlp format spec (default: best video+audio)")
+    download_parser.add_argument('--max-height', type=int, help="Highest video resolution, e.g. 720")
+    download_parser.add_argument('--audio', choices=['mp3', 'm4a', 'wav', 'flac', 'ogg'],
+                                 help="Audio only, saved in this format")
+    download_parser.add_argument('--audio-quality', default='best',
+                                 choices=['best', '320', '256', '192', '128', '96'],
+                                 help="Audio bitrate in kbps (with --audio)")
+    download_parser.add_argument('--playlist-items', help="Playlist entries to take, e.g. 1-10")
+    download_parser.add_argument('-c', '--connections', type=int, default=1,
+                                 help="Parallel range connections per stream")
+    download_parser.add_argument('-w', '--workers', type=int, default=2, help="Videos downloaded at once")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    urls = read_urls(args.urls, args.input)
+    if not urls:
+        parser.error("no URLs given (pass them as arguments, with --input, or on stdin)")
+
+    if args.command == 'info':
+        results = info(urls)
+    else:
+        if not FFmpegManager.get_ffmpeg_path():
+            logger.warning("ffmpeg not found: no merging or conversion, formats are kept as downloaded")
+        os.makedirs(args.output_dir, exist_ok=True)
+        results = download(urls, args.output_dir, format_spec=args.format, max_height=args.max_height,
+                           audio_format=args.audio, audio_quality=args.audio_quality,
+                           playlist_items=args.playlist_items, connections=args.connections,
+                           workers=args.workers)
+
+    failed = 0
+    for result in results:
+        failed += not result['ok']
+        print(json.dumps(result, default=str), flush=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
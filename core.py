@@ -0,0 +1,3438 @@
+"""Headless download engine shared by the Streamlit app, the CLI and the benchmark
+
+Nothing here imports Streamlit, and yt-dlp, requests and Pillow are loaded
+on first use, so importing this module stays cheap for workers and cron jobs.
+"""
+import os
+import subprocess
+import json
+import tempfile
+from pathlib import Path
+import time
+import re
+import importlib
+import zipfile
+import shutil
+import hashlib
+import threading
+import logging
+import mimetypes
+import sqlite3
+try:
+    import fcntl
+except ImportError:  # Windows: stale runs are recognised by age only
+    fcntl = None
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, urlparse
+
+logger = logging.getLogger('yt_downloader')
+
+class _LazyModule:
+    """Stand-in that imports the real module on first attribute access"""
+    
+    def __init__(self, name):
+        self._name = name
+    
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+# yt-dlp alone takes most of a second to import; only pay for it when used
+yt_dlp = _LazyModule('yt_dlp')
+requests = _LazyModule('requests')
+
+class Metrics:
+    """Per-stage timing spans, counters and component gauges, exported as Prometheus text or JSONL"""
+    
+    QUANTILES = (0.5, 0.99)
+    
+    def __init__(self, log_path=None, window=512):
+        self.log_path = log_path
+        self.window = window
+        self._stages = {}  # stage -> {'count', 'sum', 'recent'}
+        self._counters = {}
+        self._collectors = {}  # name -> callable returning a stats dict
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self._local = threading.local()
+    
+    @contextmanager
+    def trace(self, job_id, spans):
+        """Attribute spans recorded on this thread to a job, appending them to `spans`"""
+        previous = getattr(self._local, 'trace', None)
+        self._local.trace = (job_id, spans)
+        try:
+            yield
+        finally:
+            self._local.trace = previous
+    
+    @contextmanager
+    def span(self, stage, **fields):
+        """Time a block as one stage"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started, **fields)
+    
+    def observe(self, stage, seconds, job_id=None, spans=None, **fields):
+        """Record a stage duration measured elsewhere"""
+        trace = getattr(self._local, 'trace', None)
+        if trace and job_id is None and spans is None:
+            job_id, spans = trace
+        if spans is not None:
+            spans.append({'stage': stage, 'seconds': seconds})
+        
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                entry = self._stages[stage] = {'count': 0, 'sum': 0.0, 'recent': deque(maxlen=self.window)}
+            entry['count'] += 1
+            entry['sum'] += seconds
+            entry['recent'].append(seconds)
+        self.log({'type': 'span', 'stage': stage, 'seconds': round(seconds, 6), 'job': job_id, **fields})
+    
+    def inc(self, name, value=1):
+        """Add to a monotonically increasing counter"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+    
+    def register(self, name, collect):
+        """Export the numeric values of collect() as gauges named after `name`"""
+        with self._lock:
+            self._collectors[name] = collect
+    
+    def log(self, record):
+        """Append a record to the JSONL log, if one is configured"""
+        if not self.log_path:
+            return
+        line = json.dumps({'ts': round(time.time(), 3), **record}, default=str)
+        with self._log_lock:
+            with open(self.log_path, 'a') as f:
+                f.write(line + '\n')
+    
+    @staticmethod
+    def _quantile(values, q):
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+    
+    def stage_stats(self):
+        """Return count, total and recent quantiles per stage"""
+        with self._lock:
+            stages = {stage: (entry['count'], entry['sum'], list(entry['recent']))
+                      for stage, entry in self._stages.items()}
+        return {
+            stage: {
+                'count': count,
+                'sum': total,
+                **{f"p{int(q * 100)}": self._quantile(recent, q) for q in self.QUANTILES},
+            }
+            for stage, (count, total, recent) in stages.items()
+        }
+    
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+    
+    def gauges(self):
+        """Current numeric values from every registered collector"""
+        with self._lock:
+            collectors = list(self._collectors.items())
+        values = {}
+        for name, collect in collectors:
+            try:
+                stats = collect()
+            except Exception as e:
+                logger.debug("Metrics collector %s failed: %s", name, e)
+                continue
+            for key, value in stats.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    values[f"{name}_{key}"] = value
+        return values
+    
+    def render_prometheus(self):
+        """Prometheus text exposition of everything recorded"""
+        clean = lambda name: re.sub(r'[^a-zA-Z0-9_]', '_', name)
+        lines = ['# TYPE ytdl_stage_seconds summary']
+        for stage, stats in sorted(self.stage_stats().items()):
+            for q in self.QUANTILES:
+                lines.append(f'ytdl_stage_seconds{{stage="{stage}",quantile="{q}"}} '
+                             f'{stats[f"p{int(q * 100)}"]:.6f}')
+            lines.append(f'ytdl_stage_seconds_sum{{stage="{stage}"}} {stats["sum"]:.6f}')
+            lines.append(f'ytdl_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        for name, value in sorted(self.counters().items()):
+            lines.append(f"# TYPE ytdl_{clean(name)}_total counter")
+            lines.append(f"ytdl_{clean(name)}_total {value}")
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f"# TYPE ytdl_{clean(name)} gauge")
+            lines.append(f"ytdl_{clean(name)} {value}")
+        return '\n'.join(lines) + '\n'
+
+# Process-wide registry; the app, CLI and benchmark all report into it
+metrics = Metrics(log_path=os.environ.get('YTDL_METRICS_LOG'))
+
+class FFmpegManager:
+    """Manage FFmpeg installation for Streamlit Cloud"""
+    
+    # Candidate binaries, checked in order after the system PATH
+    POSSIBLE_PATHS = [
+        'ffmpeg',
+        '/usr/bin/ffmpeg',
+        '/usr/local/bin/ffmpeg',
+        './ffmpeg/ffmpeg',
+        './ffmpeg'
+    ]
+    
+    @staticmethod
+    def _run(ffmpeg_path, *args):
+        """Run ffmpeg with arguments and return stdout, or None on failure"""
+        try:
+            result = subprocess.run([ffmpeg_path, '-hide_banner', *args],
+                                    capture_output=True, text=True, timeout=10)
+            if result.returncode == 0:
+                return result.stdout
+        except:
+            pass
+        return None
+    
+    @staticmethod
+    def _parse_table(output):
+        """Parse names from `ffmpeg -encoders` / `-muxers` listings"""
+        names = set()
+        in_table = False
+        for line in (output or '').splitlines():
+            if line.strip().startswith('--'):
+                in_table = True
+                continue
+            if not in_table:
+                continue
+            parts = line.split()
+            if len(parts) >= 2:
+                # Muxer rows may list several comma-separated names
+                names.update(parts[1].split(','))
+        return frozenset(names)
+    
+    @staticmethod
+    def detect():
+        """Locate ffmpeg and probe its version and capabilities"""
+        capabilities = {
+            'path': None,
+            'version': None,
+            'encoders': frozenset(),
+            'muxers': frozenset(),
+            'hwaccels': (),
+            'probed_at': time.time(),
+        }
+        
+        for path in FFmpegManager.POSSIBLE_PATHS:
+            if path != 'ffmpeg' and not os.path.exists(path):
+                continue
+            output = FFmpegManager._run(path, '-version')
+            if output is None:
+                continue
+            
+            capabilities['path'] = path
+            match = re.match(r'ffmpeg version (\S+)', output)
+            capabilities['version'] = match.group(1) if match else 'unknown'
+            capabilities['encoders'] = FFmpegManager._parse_table(
+                FFmpegManager._run(path, '-encoders'))
+            capabilities['muxers'] = FFmpegManager._parse_table(
+                FFmpegManager._run(path, '-muxers'))
+            hwaccels = FFmpegManager._run(path, '-hwaccels') or ''
+            capabilities['hwaccels'] = tuple(
+                line.strip() for line in hwaccels.splitlines()[1:] if line.strip())
+            break
+        
+        return capabilities
+    
+    _capabilities = None
+    _probe_lock = threading.Lock()
+    
+    @staticmethod
+    def probe(refresh=False):
+        """Return memoized FFmpeg capabilities, re-probing only on demand"""
+        with FFmpegManager._probe_lock:
+            if refresh or FFmpegManager._capabilities is None:
+                FFmpegManager._capabilities = FFmpegManager.detect()
+            return FFmpegManager._capabilities
+    
+    @staticmethod
+    def get_ffmpeg_path():
+        """Get FFmpeg path from the memoized probe"""
+        return FFmpegManager.probe()['path']
+    
+    @staticmethod
+    def has_encoder(name):
+        """Check whether ffmpeg was built with an encoder"""
+        return name in FFmpegManager.probe()['encoders']
+    
+    @staticmethod
+    def has_muxer(name):
+        """Check whether ffmpeg can write a container format"""
+        return name in FFmpegManager.probe()['muxers']
+    
+    @staticmethod
+    def can_merge(container='mp4'):
+        """Check whether separate video and audio streams can be merged"""
+        return bool(FFmpegManager.get_ffmpeg_path()) and FFmpegManager.has_muxer(container)
+    
+    @staticmethod
+    def setup_ffmpeg():
+        """Setup FFmpeg for the application"""
+        ffmpeg_path = FFmpegManager.get_ffmpeg_path()
+        
+        if ffmpeg_path:
+            os.environ['FFMPEG_BINARY'] = ffmpeg_path
+            return True
+        else:
+            logger.warning("FFmpeg not found. Some features may be limited.")
+            return False
+
+class FormatRecord:
+    """Typed, compact view of one extracted format"""
+    
+    __slots__ = ('format_id', 'ext', 'kind', 'height', 'width', 'fps',
+                 'tbr', 'abr', 'filesize', 'vcodec', 'acodec')
+    
+    COMBINED = 'combined'
+    VIDEO = 'video'
+    AUDIO = 'audio'
+    
+    def __init__(self, fmt):
+        self.format_id = fmt.get('format_id') or ''
+        self.ext = fmt.get('ext') or ''
+        self.height = int(fmt.get('height') or 0)
+        self.width = int(fmt.get('width') or 0)
+        self.fps = float(fmt.get('fps') or 0)
+        self.tbr = float(fmt.get('tbr') or 0)
+        self.abr = float(fmt.get('abr') or 0)
+        self.filesize = int(fmt.get('filesize') or fmt.get('filesize_approx') or 0)
+        self.vcodec = (fmt.get('vcodec') or 'none').lower()
+        self.acodec = (fmt.get('acodec') or 'none').lower()
+        
+        has_video = self.vcodec != 'none' and self.height > 0
+        has_audio = self.acodec != 'none'
+        if has_video and has_audio:
+            self.kind = self.COMBINED
+        elif has_video:
+            self.kind = self.VIDEO
+        elif has_audio:
+            self.kind = self.AUDIO
+        else:
+            # Storyboards, manifests and other non-media entries
+            self.kind = None
+    
+    def fits(self, container):
+        """Check whether this format can be stored in a container without re-encoding"""
+        if not container or self.ext == container:
+            return True
+        codecs = PostProcessPlanner.CONTAINER_CODECS.get(container)
+        if codecs is None:
+            return False
+        return (
+            (self.vcodec == 'none' or self.vcodec.startswith(codecs['video']))
+            and (self.acodec == 'none' or self.acodec.startswith(codecs['audio']))
+        )
+
+class FormatIndex:
+    """Format records built once per video, answering ranked in-memory queries"""
+    
+    RECORD_BYTES = 200  # rough per-record footprint for cache accounting
+    
+    def __init__(self, formats):
+        self.records = [record for record in map(FormatRecord, formats or []) if record.kind]
+        self._by_id = {record.format_id: record for record in self.records}
+    
+    @classmethod
+    def for_info(cls, info):
+        """Return the index cached on an info dict, building it on first use"""
+        index = info.get('_format_index')
+        if index is None:
+            index = cls(info.get('formats'))
+            info['_format_index'] = index
+        return index
+    
+    def nbytes(self):
+        return len(self.records) * self.RECORD_BYTES
+    
+    def get(self, format_id):
+        return self._by_id.get(format_id)
+    
+    @property
+    def max_height(self):
+        return max((record.height for record in self.records), default=0)
+    
+    def query(self, kind=None, max_height=None, container=None, order='quality', limit=None):
+        """Filter records and rank them by 'quality' (best first) or 'size' (smallest first)"""
+        matches = [
+            record for record in self.records
+            if (kind is None or record.kind == kind)
+            and (max_height is None or record.height <= max_height)
+            and record.fits(container)
+        ]
+        if order == 'size':
+            # Unknown sizes rank last
+            matches.sort(key=lambda r: (r.filesize == 0, r.filesize, -r.height, -r.abr))
+        else:
+            matches.sort(key=lambda r: (r.height, r.fps, r.abr, r.tbr), reverse=True)
+        return matches[:limit] if limit else matches
+    
+    def best(self, **kwargs):
+        """First result of a ranked query, or None"""
+        results = self.query(limit=1, **kwargs)
+        return results[0] if results else None
+    
+    def best_per_height(self, kind, max_height=None, container=None):
+        """Highest bitrate record for each distinct height, tallest first"""
+        picked = OrderedDict()
+        for record in self.query(kind=kind, max_height=max_height, container=container):
+            current = picked.get(record.height)
+            if current is None or record.tbr > current.tbr:
+                picked[record.height] = record
+        return list(picked.values())
+
+class MetadataCache:
+    """Process-wide TTL + LRU cache for extracted video metadata"""
+    
+    # Top-level info fields the app actually reads
+    INFO_FIELDS = (
+        'id', 'title', 'uploader', 'duration', 'duration_string', 'thumbnail',
+        'view_count', 'upload_date', 'description', 'webpage_url'
+    )
+    # Per-format fields used for format listing and selection
+    FORMAT_FIELDS = (
+        'format_id', 'format_note', 'ext', 'height', 'width', 'fps',
+        'vcodec', 'acodec', 'abr', 'tbr', 'vbr', 'asr',
+        'filesize', 'filesize_approx', 'protocol', 'url', 'http_headers'
+    )
+    DESCRIPTION_LIMIT = 500
+    
+    _VIDEO_ID_RE = re.compile(
+        r'(?:v=|youtu\.be/|/shorts/|/embed/|/live/|/v/)([0-9A-Za-z_-]{11})'
+    )
+    
+    def __init__(self, ttl=300, max_bytes=32 * 1024 * 1024, persist=None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # HistoryStore that keeps fresh extractions across restarts, or None
+        self.persist = persist
+        self._entries = OrderedDict()  # key -> (expires_at, size, info)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    @classmethod
+    def normalize_key(cls, url):
+        """Normalize a YouTube URL to its video ID"""
+        match = cls._VIDEO_ID_RE.search(url or '')
+        if match:
+            return match.group(1)
+        return (url or '').strip()
+    
+    @classmethod
+    def slim_info(cls, info):
+        """Keep only the fields the app uses"""
+        slim = {key: info.get(key) for key in cls.INFO_FIELDS if key in info}
+        if slim.get('description'):
+            slim['description'] = slim['description'][:cls.DESCRIPTION_LIMIT]
+        slim['formats'] = [
+            {key: fmt[key] for key in cls.FORMAT_FIELDS if key in fmt}
+            for fmt in info.get('formats') or []
+        ]
+        return slim
+    
+    @staticmethod
+    def estimate_size(info):
+        """Approximate in-memory size of an entry in bytes"""
+        return len(json.dumps(info, default=str))
+    
+    def get(self, url):
+        """Return cached info for a URL, or None on miss/expiry"""
+        key = self.normalize_key(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, size, info = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self._size -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return info
+    
+    def put(self, url, info, fetched_at=None):
+        """Store slimmed info for a URL and return it
+        
+        fetched_at backdates an entry reloaded from the history store, so it
+        expires when the original extraction would have.
+        """
+        key = self.normalize_key(url)
+        slim = self.slim_info(info)
+        if self.persist and fetched_at is None:
+            self.persist.record_info(key, url, slim)
+        size = self.estimate_size(slim)
+        # Build the format index once so sidebar filtering stays in memory
+        size += FormatIndex.for_info(slim).nbytes()
+        if size > self.max_bytes:
+            return slim
+        
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = ((fetched_at or time.time()) + self.ttl, size, slim)
+            self._size += size
+            
+            # Evict least recently used entries until under the byte cap
+            while self._size > self.max_bytes and self._entries:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+        return slim
+    
+    def clear(self):
+        """Drop all cached entries"""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+    
+    def stats(self):
+        """Return cache counters and current usage"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+class PostProcessPlanner:
+    """Decide between no-op, stream-copy remux and transcode for a job"""
+    
+    # Codec prefixes that each container can hold without re-encoding
+    CONTAINER_CODECS = {
+        'mp4': {
+            'video': ('avc1', 'h264', 'hev1', 'hvc1', 'h265', 'av01'),
+            'audio': ('mp4a', 'aac', 'mp3', 'ac-3', 'ec-3'),
+        },
+        'webm': {
+            'video': ('vp8', 'vp9', 'vp09', 'av01'),
+            'audio': ('opus', 'vorbis'),
+        },
+    }
+    
+    @staticmethod
+    def _find_format(formats, selector, allowed=None):
+        """Resolve one component of a format spec against extracted formats"""
+        allowed = allowed or {'video': (), 'audio': ()}
+        
+        if selector == 'bestaudio':
+            audio = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+            # Prefer audio the target container can hold so the merge stays a stream copy
+            preferred = [f for f in audio if (f.get('acodec') or '').lower().startswith(allowed['audio'])]
+            return max(preferred or audio, key=lambda f: f.get('abr') or 0, default=None)
+        
+        match = re.match(r'bestvideo(?:\[height<=(\d+)\])?$', selector)
+        if match:
+            limit = int(match.group(1)) if match.group(1) else None
+            video = [
+                f for f in formats
+                if f.get('vcodec') not in (None, 'none') and f.get('acodec') == 'none'
+                and (limit is None or (f.get('height') or 0) <= limit)
+            ]
+            # Highest resolution first, then a codec the container can hold
+            return max(video, key=lambda f: (
+                (f.get('height') or 0),
+                (f.get('vcodec') or '').lower().startswith(allowed['video']),
+                (f.get('tbr') or 0)
+            ), default=None)
+        
+        match = re.match(r'best(?:\[height<=(\d+)\])?$', selector)
+        if match:
+            limit = int(match.group(1)) if match.group(1) else None
+            combined = [
+                f for f in formats
+                if f.get('vcodec') not in (None, 'none') and f.get('acodec') not in (None, 'none')
+                and (limit is None or (f.get('height') or 0) <= limit)
+            ]
+            return max(combined, key=lambda f: ((f.get('height') or 0), (f.get('tbr') or 0)), default=None)
+        
+        for fmt in formats:
+            if fmt.get('format_id') == selector:
+                return fmt
+        return None
+    
+    @staticmethod
+    def resolve(info, format_id, allowed=None):
+        """Resolve a format spec to the list of formats it selects, or None"""
+        formats = (info or {}).get('formats') or []
+        # Only the first alternative of a "a/b" fallback spec is planned for
+        spec = format_id.split('/')[0]
+        selected = []
+        for part in spec.split('+'):
+            fmt = PostProcessPlanner._find_format(formats, part, allowed)
+            if fmt is None:
+                return None
+            selected.append(fmt)
+        return selected
+    
+    @staticmethod
+    def _compatible(codec, allowed):
+        codec = (codec or 'none').lower()
+        return codec == 'none' or codec.startswith(allowed)
+    
+    # Source audio codecs each audio target can hold as a plain stream copy
+    AUDIO_CONTAINER_CODECS = {
+        'm4a': ('mp4a', 'aac', 'alac'),
+        'mp3': ('mp3',),
+        'ogg': ('opus', 'vorbis', 'flac'),
+        'flac': ('flac',),
+        'wav': ('pcm',),
+    }
+    # Bitrates within this share of the requested quality still count (e.g. 129.5 for 128)
+    AUDIO_QUALITY_TOLERANCE = 0.9
+    
+    @staticmethod
+    def plan_for(info, format_id, options=None):
+        """Plan a video download, or an audio extraction when options ask for one
+        
+        options['container'] fixes the output container; without it the first
+        of mp4 and webm that avoids a transcode is used.
+        """
+        options = options or {}
+        if options.get('audio_format'):
+            return PostProcessPlanner.plan_audio(info, format_id, options['audio_format'],
+                                                 options.get('audio_quality'))
+        if options.get('container'):
+            return PostProcessPlanner.plan(info, format_id, options['container'])
+        plans = [PostProcessPlanner.plan(info, format_id, target) for target in PostProcessPlanner.CONTAINER_CODECS]
+        return next((plan for plan in plans if plan['action'] != 'transcode'), plans[0])
+    
+    @staticmethod
+    def pick_audio(index, audio_format, audio_quality=None):
+        """Smallest audio-only record meeting the quality, preferring ones that need no transcode"""
+        records = index.query(kind=FormatRecord.AUDIO)
+        if not records:
+            return None
+        copyable = PostProcessPlanner.AUDIO_CONTAINER_CODECS.get(audio_format, ())
+        
+        if not audio_quality or audio_quality == 'best':
+            # A stream-copyable record within tolerance of the top bitrate beats a re-encode
+            # of a marginally higher one (AAC 129kbps over Opus 140kbps for m4a)
+            floor = max(r.abr for r in records) * PostProcessPlanner.AUDIO_QUALITY_TOLERANCE
+            close = [r for r in records if r.abr >= floor and r.acodec.startswith(copyable)]
+            return max(close or records, key=lambda r: (r.abr, r.acodec.startswith(copyable), -r.filesize))
+        
+        floor = float(audio_quality) * PostProcessPlanner.AUDIO_QUALITY_TOLERANCE
+        meeting = sorted((r for r in records if r.abr >= floor),
+                         key=lambda r: (r.abr, r.filesize or float('inf')))
+        if not meeting:
+            return max(records, key=lambda r: r.abr)
+        return next((r for r in meeting if r.acodec.startswith(copyable)), meeting[0])
+    
+    @staticmethod
+    def plan_audio(info, format_id, audio_format, audio_quality=None):
+        """Plan an audio-only download: no video bytes, stream copy when the codec already fits"""
+        plan = {
+            'action': 'none',
+            'format_id': format_id,
+            'target': audio_format,
+            'postprocessors': [],
+            'merge_output_format': None,
+            'reason': '',
+            'streams': [],
+            'audio_bitrate': None if audio_quality in (None, 'best') else int(audio_quality),
+        }
+        
+        index = FormatIndex.for_info(info or {})
+        record = index.get(format_id)
+        if record is None or record.kind != FormatRecord.AUDIO:
+            # "bestaudio"-style selector: choose the stream ourselves
+            record = PostProcessPlanner.pick_audio(index, audio_format, audio_quality)
+        if record is None:
+            plan['format_id'] = 'bestaudio/best'
+            plan['action'] = 'transcode'
+            plan['reason'] = 'no audio-only formats listed'
+        else:
+            plan['format_id'] = record.format_id
+            plan['streams'] = [{'format_id': record.format_id, 'size': record.filesize or None}]
+            copyable = PostProcessPlanner.AUDIO_CONTAINER_CODECS.get(audio_format, ())
+            source = f"{record.acodec} {int(record.abr)}kbps"
+            if record.ext == audio_format and record.acodec.startswith(copyable):
+                plan['reason'] = f"already {audio_format} ({source})"
+            elif record.acodec.startswith(copyable):
+                plan['action'] = 'remux'
+                plan['reason'] = f"stream copy {source} into {audio_format}"
+            else:
+                plan['action'] = 'transcode'
+                plan['reason'] = f"transcode {source} to {audio_format}"
+        
+        if not FFmpegManager.get_ffmpeg_path():
+            # Keep the original audio file rather than failing
+            plan['action'] = 'none'
+            plan['reason'] = 'ffmpeg not available, keeping source audio'
+        elif plan['action'] != 'none':
+            plan['postprocessors'] = [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': audio_format,
+                'preferredquality': str(plan['audio_bitrate'] or 0),
+            }]
+        return plan
+    
+    @staticmethod
+    def plan(info, format_id, target='mp4'):
+        """Build the post-processing plan for a format selection"""
+        plan = {
+            'action': 'none',
+            'format_id': format_id,
+            'target': target,
+            'postprocessors': [],
+            'merge_output_format': target,
+            'reason': '',
+            'streams': [],
+        }
+        
+        allowed = PostProcessPlanner.CONTAINER_CODECS.get(target)
+        selected = PostProcessPlanner.resolve(info, format_id, allowed)
+        # Expected streams let progress reporting weigh parts it has not seen yet
+        plan['streams'] = [
+            {'format_id': f.get('format_id'), 'size': f.get('filesize') or f.get('filesize_approx')}
+            for f in selected or []
+        ]
+        
+        if not FFmpegManager.get_ffmpeg_path():
+            plan['merge_output_format'] = None
+            plan['reason'] = 'ffmpeg not available'
+            return plan
+        
+        if selected and len(selected) > 1 and 'best' in format_id.split('/')[0]:
+            # Pin the container-compatible streams picked above
+            plan['format_id'] = '+'.join(f['format_id'] for f in selected)
+        
+        if selected is None or allowed is None:
+            # Unknown codecs: keep the previous always-convert behaviour
+            plan['action'] = 'transcode'
+            plan['reason'] = 'could not resolve codecs for format selection'
+        else:
+            codecs = [(f.get('vcodec'), f.get('acodec')) for f in selected]
+            compatible = all(
+                PostProcessPlanner._compatible(vcodec, allowed['video'])
+                and PostProcessPlanner._compatible(acodec, allowed['audio'])
+                for vcodec, acodec in codecs
+            )
+            summary = ', '.join(f"{v or 'none'}/{a or 'none'}" for v, a in codecs)
+            if not compatible:
+                plan['action'] = 'transcode'
+                plan['reason'] = f"codecs {summary} not supported by {target}"
+            elif len(selected) == 1 and selected[0].get('ext') == target:
+                plan['reason'] = f"already {target} ({summary})"
+            else:
+                plan['action'] = 'remux'
+                plan['reason'] = f"stream copy into {target} ({summary})"
+        
+        if plan['action'] == 'remux' and FFmpegManager.has_muxer(target):
+            plan['postprocessors'] = [{
+                'key': 'FFmpegVideoRemuxer',
+                'preferedformat': target,
+            }]
+        elif plan['action'] == 'transcode' and FFmpegManager.has_muxer(target):
+            plan['postprocessors'] = [{
+                'key': 'FFmpegVideoConvertor',
+                'preferedformat': target,
+            }]
+        return plan
+
+class BudgetSelector:
+    """Pick the best format predicted to finish within a time budget or fit a size budget
+    
+    Predictions combine each format's filesize (or filesize_approx, or bitrate
+    × duration) with throughput and overhead measured on recent downloads,
+    seeded from the history store so they survive restarts.
+    """
+    
+    DEFAULT_THROUGHPUT = 1024 * 1024  # bytes/s assumed until a download has been measured
+    DEFAULT_OVERHEAD = 5.0  # seconds outside the transfer: extraction, rate limiting, ffmpeg
+    # Plan for a slower-than-typical transfer so most jobs land inside their budget
+    THROUGHPUT_QUANTILE = 0.25
+    # Smaller transfers mostly measure request latency, not bandwidth
+    MIN_SAMPLE_BYTES = 512 * 1024
+    # Seconds of libx264 'veryfast' work per second of 1080p video on a small instance
+    TRANSCODE_SECONDS_PER_SECOND = 1.0
+    
+    def __init__(self, history=None, window=50):
+        self._samples = deque(maxlen=window)  # (bytes per second, overhead seconds), oldest first
+        self._errors = deque(maxlen=window)  # actual / predicted seconds of budgeted jobs
+        self._lock = threading.Lock()
+        self.budgeted = 0
+        self.met = 0
+        if history:
+            self._samples.extend(history.throughput_samples(window, self.MIN_SAMPLE_BYTES))
+    
+    def estimate(self):
+        """Current planning throughput (bytes/s) and fixed overhead (s)"""
+        with self._lock:
+            samples = list(self._samples)
+        if not samples:
+            return self.DEFAULT_THROUGHPUT, self.DEFAULT_OVERHEAD
+        return (Metrics._quantile([rate for rate, _ in samples], self.THROUGHPUT_QUANTILE),
+                Metrics._quantile([overhead for _, overhead in samples], 0.5))
+    
+    @staticmethod
+    def estimate_bytes(record, duration):
+        """Expected download size of one format, or None if unknown"""
+        if record.filesize:
+            return record.filesize
+        if record.tbr and duration:
+            return int(record.tbr * 125 * duration)
+        return None
+    
+    @classmethod
+    def candidates(cls, info, download_type="Video + Audio", max_height=None, container=None):
+        """Downloadable format selections, best quality first, with their expected size"""
+        index = FormatIndex.for_info(info)
+        if download_type == "Audio Only":
+            selections = [(record,) for record in index.query(kind=FormatRecord.AUDIO)]
+        elif download_type == "Video Only":
+            selections = [(record,) for record in index.best_per_height(FormatRecord.VIDEO, max_height, container)]
+        else:
+            selections = [(record,) for record in index.best_per_height(FormatRecord.COMBINED, max_height, container)]
+            if FFmpegManager.can_merge():
+                for record in index.best_per_height(FormatRecord.VIDEO, max_height, container):
+                    # Audio the merge container can hold, named explicitly so the prediction
+                    # covers exactly what is fetched and the merge stays a stream copy
+                    target = container or next(
+                        (name for name in PostProcessPlanner.CONTAINER_CODECS if record.fits(name)), None)
+                    audio = index.best(kind=FormatRecord.AUDIO, container=target)
+                    if audio:
+                        selections.append((record, audio))
+        
+        options = {'container': container} if container else {}
+        candidates = []
+        for records in selections:
+            sizes = [cls.estimate_bytes(record, info.get('duration')) for record in records]
+            format_id = '+'.join(record.format_id for record in records)
+            # Audio extraction re-encodes a few kbps; a video transcode costs real time
+            transcode = (download_type != "Audio Only"
+                         and PostProcessPlanner.plan_for(info, format_id, options)['action'] == 'transcode')
+            candidates.append({
+                'format_id': format_id,
+                'height': max(record.height for record in records),
+                'ext': records[0].ext,
+                'bytes': sum(sizes) if all(sizes) else None,
+                'transcode': transcode,
+                'rank': (max(record.height for record in records), max(record.fps for record in records),
+                         sum(record.abr for record in records), sum(record.tbr for record in records)),
+            })
+        candidates.sort(key=lambda candidate: candidate['rank'], reverse=True)
+        return candidates
+    
+    @classmethod
+    def transcode_seconds(cls, info, height):
+        """Expected ffmpeg time to re-encode a video, scaled by pixel count from 1080p"""
+        return (info.get('duration') or 0) * cls.TRANSCODE_SECONDS_PER_SECOND * ((height or 1080) / 1080) ** 2
+    
+    def select(self, info, seconds=None, megabytes=None, download_type="Video + Audio",
+               max_height=None, container=None):
+        """Best candidate predicted to meet the budget, else the smallest one, or None
+        
+        The result is the prediction stored on the job: format, expected size and
+        duration, the budget and whether it is expected to be met.
+        """
+        throughput, overhead = self.estimate()
+        chosen = smallest = None
+        for candidate in self.candidates(info, download_type, max_height, container):
+            if candidate['bytes'] is None:
+                continue
+            predicted_seconds = overhead + candidate['bytes'] / throughput
+            if candidate['transcode']:
+                predicted_seconds += self.transcode_seconds(info, candidate['height'])
+            if ((seconds is None or predicted_seconds <= seconds)
+                    and (megabytes is None or candidate['bytes'] <= megabytes * 1024 * 1024)):
+                chosen = (candidate, predicted_seconds)
+                break
+            if smallest is None or candidate['bytes'] < smallest[0]['bytes']:
+                smallest = (candidate, predicted_seconds)
+        if not (chosen or smallest):
+            return None
+        candidate, predicted_seconds = chosen or smallest
+        return {
+            'format_id': candidate['format_id'],
+            'height': candidate['height'],
+            'ext': candidate['ext'],
+            'predicted_bytes': candidate['bytes'],
+            'predicted_seconds': predicted_seconds,
+            'transcode': candidate['transcode'],
+            'throughput': throughput,
+            'budget_seconds': seconds,
+            'budget_mb': megabytes,
+            'fits': chosen is not None,
+        }
+    
+    @staticmethod
+    def outcome(job):
+        """Actual duration and size of a finished job, and whether it met its budget"""
+        prediction = job['prediction']
+        seconds = job['finished_at'] - (job['started_at'] or job['created_at'])
+        size = os.path.getsize(job['filename']) if os.path.isfile(job['filename'] or '') else job['downloaded_bytes']
+        return {
+            'seconds': seconds,
+            'bytes': size,
+            'met': ((prediction['budget_seconds'] is None or seconds <= prediction['budget_seconds'])
+                    and (prediction['budget_mb'] is None or size <= prediction['budget_mb'] * 1024 * 1024)),
+        }
+    
+    def observe(self, job):
+        """Learn throughput from a finished job snapshot and score its prediction"""
+        if job['status'] != DownloadJob.DONE or job['cache_hit']:
+            return
+        transfer = sum(span['seconds'] for span in job['spans'] if span['stage'] == 'download')
+        seconds = job['finished_at'] - (job['started_at'] or job['created_at'])
+        if job['downloaded_bytes'] >= self.MIN_SAMPLE_BYTES and transfer > 0:
+            with self._lock:
+                self._samples.append((job['downloaded_bytes'] / transfer, max(seconds - transfer, 0.0)))
+        
+        prediction = job['prediction']
+        if not prediction:
+            return
+        outcome = self.outcome(job)
+        with self._lock:
+            self.budgeted += 1
+            self.met += outcome['met']
+            if prediction['predicted_seconds']:
+                self._errors.append(outcome['seconds'] / prediction['predicted_seconds'])
+        metrics.inc('budget_jobs')
+        metrics.inc('budget_met', int(outcome['met']))
+        metrics.log({'type': 'budget', 'job': job['id'], 'format_id': prediction['format_id'],
+                     'predicted_seconds': round(prediction['predicted_seconds'], 3),
+                     'actual_seconds': round(outcome['seconds'], 3),
+                     'predicted_bytes': prediction['predicted_bytes'], 'actual_bytes': outcome['bytes'],
+                     'met': outcome['met']})
+        logger.info("Job %s budget %s: predicted %.1fs / %s bytes, took %.1fs / %s bytes",
+                    job['id'], "met" if outcome['met'] else "missed", prediction['predicted_seconds'],
+                    prediction['predicted_bytes'], outcome['seconds'], outcome['bytes'])
+    
+    def stats(self):
+        """Return the planning estimate and how often budgets were met"""
+        throughput, overhead = self.estimate()
+        with self._lock:
+            return {
+                'samples': len(self._samples),
+                'throughput': throughput,
+                'overhead': overhead,
+                'budgeted': self.budgeted,
+                'met': self.met,
+                'met_rate': self.met / self.budgeted if self.budgeted else 0.0,
+                'time_ratio_p50': Metrics._quantile(self._errors, 0.5),
+            }
+
+class StreamingZipPackager:
+    """Build a STORED ZIP of finished files chunk by chunk, never in full"""
+    
+    class _ChunkSink:
+        """Write-only, non-seekable sink that zipfile streams into"""
+        
+        def __init__(self):
+            self.buffer = bytearray()
+        
+        def write(self, data):
+            self.buffer.extend(data)
+            return len(data)
+        
+        def flush(self):
+            pass
+        
+        def drain(self):
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            return data
+    
+    def __init__(self, paths, chunk_size=1024 * 1024):
+        self.paths = [path for path in paths if os.path.isfile(path)]
+        self.chunk_size = chunk_size
+    
+    @classmethod
+    def from_directory(cls, directory, **kwargs):
+        """Package every regular file in a directory, e.g. a downloader's output_path"""
+        partial_suffixes = ('.part', '.rpart', '.ranges', '.ytdl')
+        paths = sorted(str(path) for path in Path(directory).iterdir()
+                       if path.is_file() and not path.name.endswith(partial_suffixes))
+        return cls(paths, **kwargs)
+    
+    def _arcnames(self):
+        """Unique archive names for the input files"""
+        seen = set()
+        for path in self.paths:
+            stem, ext = os.path.splitext(os.path.basename(path))
+            name, counter = f"{stem}{ext}", 1
+            while name in seen:
+                name, counter = f"{stem} ({counter}){ext}", counter + 1
+            seen.add(name)
+            yield path, name
+    
+    def __iter__(self):
+        """Yield the archive as byte chunks"""
+        sink = self._ChunkSink()
+        with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for path, arcname in self._arcnames():
+                entry = zipfile.ZipInfo.from_file(path, arcname)
+                entry.compress_type = zipfile.ZIP_STORED
+                # Media is already compressed; store as-is and stream the bytes through
+                with open(path, 'rb') as source, archive.open(entry, 'w', force_zip64=True) as target:
+                    while True:
+                        chunk = source.read(self.chunk_size)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+                        yield sink.drain()
+                yield sink.drain()
+        # Central directory is written on close
+        tail = sink.drain()
+        if tail:
+            yield tail
+
+class DeliveryServer:
+    """Local HTTP endpoint that streams packaged downloads to the browser
+    
+    Binds to loopback by default; expose it through a reverse proxy and pass
+    that public URL as base_url for browsers on other machines. With
+    port=None nothing is bound: route() serves the published links from the
+    Streamlit server's own origin instead.
+    """
+    
+    def __init__(self, host='127.0.0.1', port=8502, base_url=None, ttl=3600, metrics=None):
+        self.ttl = ttl
+        # Served as Prometheus text on /metrics when given
+        self.metrics = metrics
+        self._routes = {}
+        self._lock = threading.Lock()
+        # Whether route() was mounted on a web server
+        self.mounted = False
+        
+        if port is None:
+            self._httpd = None
+            self.port = None
+            self.base_url = (base_url or '').rstrip('/')
+            return
+        
+        try:
+            self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        except OSError as e:
+            if base_url:
+                # A public URL configured for this port would reach some other process
+                raise RuntimeError(f"Delivery server cannot bind {host}:{port} ({e}), "
+                                   f"but {base_url} is configured to reach it") from e
+            # Port taken (e.g. a second app process); fall back to any free port
+            self._httpd = ThreadingHTTPServer((host, 0), self._make_handler())
+            logger.warning("Delivery port %d in use, serving on %d instead", port, self._httpd.server_address[1])
+        self._httpd.daemon_threads = True
+        self.port = self._httpd.server_address[1]
+        self.base_url = (base_url or f"http://localhost:{self.port}").rstrip('/')
+        
+        thread = threading.Thread(target=self._httpd.serve_forever, name='delivery-server', daemon=True)
+        thread.start()
+    
+    def publish_stream(self, filename, factory, content_type='application/octet-stream'):
+        """Expose a chunk iterator factory under a one-off URL and return it"""
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._expire()
+            self._routes[token] = {
+                'filename': filename,
+                'factory': factory,
+                'content_type': content_type,
+                'expires_at': time.time() + self.ttl,
+            }
+        return f"{self.base_url}/d/{token}/{quote(filename)}"
+    
+    def publish_file(self, path, filename=None, content_type=None):
+        """Expose a finished file for ranged, zero-copy streaming and return its URL"""
+        path = os.path.abspath(path)
+        filename = filename or os.path.basename(path)
+        content_type = content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        with self._lock:
+            self._expire()
+            # Reruns republish the same file; keep its link stable and extend it
+            token = next((t for t, route in self._routes.items()
+                          if route.get('path') == path and route['filename'] == filename), None)
+            token = token or uuid.uuid4().hex
+            self._routes[token] = {
+                'filename': filename,
+                'path': path,
+                'content_type': content_type,
+                'expires_at': time.time() + self.ttl,
+            }
+        return f"{self.base_url}/d/{token}/{quote(filename)}"
+    
+    def route(self):
+        """Starlette route serving the published links, to mount on Streamlit's own server
+        
+        Files go out in fixed-size chunks with Range support and streams chunk
+        by chunk, so memory use is independent of download size.
+        """
+        from starlette.responses import FileResponse, PlainTextResponse, StreamingResponse
+        from starlette.routing import Route
+        
+        async def serve(request):
+            route = self._lookup(request.path_params['token'])
+            if route is None:
+                return PlainTextResponse("Download link expired or unknown", status_code=404)
+            if 'path' not in route:
+                disposition = f"attachment; filename*=UTF-8''{quote(route['filename'])}"
+                return StreamingResponse(route['factory'](), media_type=route['content_type'],
+                                         headers={'Content-Disposition': disposition})
+            if not os.path.isfile(route['path']):
+                return PlainTextResponse("File no longer available", status_code=404)
+            return FileResponse(route['path'], media_type=route['content_type'], filename=route['filename'],
+                                # Already-compressed media: keep gzip middleware out of the way
+                                headers={'Content-Encoding': 'identity'})
+        
+        self.mounted = True
+        return Route(f"{self.base_url}/d/{{token}}/{{filename:path}}", serve, methods=['GET', 'HEAD'])
+    
+    @staticmethod
+    def parse_range(header, size):
+        """(start, end) inclusive for a single "bytes=" range, None for the whole file, False if unsatisfiable"""
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', (header or '').strip())
+        if not match or not any(match.groups()):
+            return None
+        first, last = match.groups()
+        if not first:
+            # Suffix range: the final N bytes
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        if start >= size or start > end:
+            return False
+        return start, end
+    
+    def _expire(self):
+        now = time.time()
+        for token in [t for t, route in self._routes.items() if route['expires_at'] <= now]:
+            del self._routes[token]
+    
+    def _lookup(self, token):
+        with self._lock:
+            route = self._routes.get(token)
+        if route and route['expires_at'] > time.time():
+            return route
+        return None
+    
+    def _make_handler(self):
+        server = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._serve(head=False)
+            
+            def do_HEAD(self):
+                self._serve(head=True)
+            
+            def _serve(self, head):
+                if self.path == '/metrics' and server.metrics:
+                    body = server.metrics.render_prometheus().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    if not head:
+                        self.wfile.write(body)
+                    return
+                
+                parts = self.path.split('/')
+                route = server._lookup(parts[2]) if len(parts) > 2 and parts[1] == 'd' else None
+                if route is None:
+                    self.send_error(404, "Download link expired or unknown")
+                    return
+                
+                try:
+                    if 'path' in route:
+                        self._send_file(route, head)
+                    else:
+                        self._send_headers(200, route)
+                        if not head:
+                            for chunk in route['factory']():
+                                if chunk:
+                                    self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+            
+            def _send_headers(self, status, route, extra=None):
+                self.send_response(status)
+                self.send_header('Content-Type', route['content_type'])
+                self.send_header('Content-Disposition',
+                                 f"attachment; filename*=UTF-8''{quote(route['filename'])}")
+                for name, value in (extra or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Connection', 'close')
+                self.end_headers()
+            
+            def _send_file(self, route, head):
+                try:
+                    f = open(route['path'], 'rb')
+                except OSError:
+                    self.send_error(404, "File no longer available")
+                    return
+                
+                with f:
+                    size = os.fstat(f.fileno()).st_size
+                    byte_range = server.parse_range(self.headers.get('Range'), size)
+                    if byte_range is False:
+                        self.send_response(416)
+                        self.send_header('Content-Range', f"bytes */{size}")
+                        self.send_header('Content-Length', '0')
+                        self.send_header('Connection', 'close')
+                        self.end_headers()
+                        return
+                    
+                    start, end = byte_range or (0, size - 1)
+                    headers = {'Accept-Ranges': 'bytes', 'Content-Length': str(end - start + 1)}
+                    if byte_range:
+                        headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+                    self._send_headers(206 if byte_range else 200, route, headers)
+                    if not head and size:
+                        # Kernel-side copy: memory use is independent of file size
+                        self.connection.sendfile(f, offset=start, count=end - start + 1)
+            
+            def log_message(self, format, *args):
+                logger.debug("delivery: " + format, *args)
+        
+        return Handler
+
+# Links served from the app's own origin when streamlit_app.py mounts its route
+same_origin = DeliveryServer(port=None, base_url='/files')
+
+class ScratchStore:
+    """Managed scratch space for downloads with quota and age-based eviction"""
+    
+    def __init__(self, root=None, quota_bytes=2 * 1024 ** 3, max_age=3600, sweep_interval=60):
+        self.root = Path(root or os.path.join(tempfile.gettempdir(), 'yt-downloader'))
+        self.quota_bytes = quota_bytes
+        self.max_age = max_age
+        self.run_dir = self.root / f"run-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._active = {}  # path -> open lock file (or None without fcntl)
+        self._lock = threading.Lock()
+        self.evicted_dirs = 0
+        self.evicted_bytes = 0
+        self.last_usage = 0
+        self.last_sweep = None
+        
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.run_dir.mkdir()
+        # Held for the life of this store; other stores (any process or container) see the run as live
+        self._run_lock = open(self.run_dir / self.LOCK_NAME, 'w')
+        if fcntl:
+            fcntl.flock(self._run_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.cleanup_stale_runs()
+        self.sweep()
+        
+        if sweep_interval:
+            janitor = threading.Thread(target=self._janitor, args=(sweep_interval,),
+                                       name='scratch-janitor', daemon=True)
+            janitor.start()
+    
+    LOCK_NAME = '.run.lock'
+    JOB_LOCK_NAME = '.job.lock'
+    
+    @staticmethod
+    def _held_elsewhere(lock_path):
+        """Whether some other open file holds a lock file's flock; None if that can't be tested"""
+        if not fcntl or not lock_path.exists():
+            return None
+        try:
+            with open(lock_path, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        return False
+    
+    def _run_is_live(self, path):
+        """Whether another store still holds a run directory's lock"""
+        held = self._held_elsewhere(path / self.LOCK_NAME)
+        if held is None:
+            # No lock to test: only age tells the run is gone
+            try:
+                return time.time() - path.stat().st_mtime < self.max_age
+            except OSError:
+                return False
+        return held
+    
+    @staticmethod
+    def dir_size(path):
+        """Total size of regular files under a directory"""
+        total = 0
+        for dirpath, _, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    pass
+        return total
+    
+    def cleanup_stale_runs(self):
+        """Remove scratch directories left behind by processes that are gone"""
+        removed = 0
+        for path in self.root.glob('run-*'):
+            # PIDs say nothing across containers sharing the volume, or for other stores in this process
+            if path != self.run_dir and path.is_dir() and not self._run_is_live(path):
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        if removed:
+            logger.info("Removed %d stale scratch directories from %s", removed, self.root)
+        return removed
+    
+    def session_dir(self, session_id):
+        """Directory for files scoped to one browser session"""
+        path = self.run_dir / 'sessions' / session_id
+        path.mkdir(parents=True, exist_ok=True)
+        return str(path)
+    
+    def job_dir(self, job_key):
+        """Directory for one download's output, stable across restarts so partial files resume"""
+        path = self.root / 'jobs' / job_key
+        path.mkdir(parents=True, exist_ok=True)
+        return str(path)
+    
+    def acquire(self, path):
+        """Protect a directory from eviction while it is being written
+        
+        Job directories are shared by every store on the volume, so the
+        protection is a lock file other processes' sweeps test as well.
+        """
+        lock_file = None
+        if fcntl:
+            lock_file = open(os.path.join(path, self.JOB_LOCK_NAME), 'w')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # Fresh mtime keeps age-only sweeps (no fcntl) off it too
+        os.utime(path)
+        with self._lock:
+            self._active[str(path)] = lock_file
+    
+    def release(self, path):
+        with self._lock:
+            lock_file = self._active.pop(str(path), None)
+        if lock_file:
+            lock_file.close()
+    
+    def _leaf_dirs(self):
+        for base in (self.run_dir / 'sessions', self.root / 'jobs'):
+            if base.is_dir():
+                yield from (path for path in base.iterdir() if path.is_dir())
+    
+    def sweep(self):
+        """Evict expired directories, then the oldest ones until under quota"""
+        now = time.time()
+        # Heartbeat for stores that can't test the run lock
+        os.utime(self.run_dir)
+        with self._lock:
+            active = set(self._active)
+        
+        entries = []
+        for path in self._leaf_dirs():
+            try:
+                mtime = path.stat().st_mtime
+            except OSError:
+                continue
+            entries.append([mtime, self.dir_size(path), path])
+        entries.sort(key=lambda entry: entry[0])
+        
+        usage = sum(entry[1] for entry in entries)
+        for mtime, size, path in entries:
+            if str(path) in active or self._held_elsewhere(path / self.JOB_LOCK_NAME):
+                continue
+            expired = now - mtime > self.max_age
+            if not expired and usage <= self.quota_bytes:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            usage -= size
+            self.evicted_dirs += 1
+            self.evicted_bytes += size
+        
+        self.last_usage = usage
+        self.last_sweep = now
+        return usage
+    
+    def has_room(self):
+        """Check whether usage is under quota after a sweep"""
+        return self.sweep() < self.quota_bytes
+    
+    def _janitor(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.warning("Scratch sweep failed: %s", e)
+    
+    def stats(self):
+        """Return current usage and eviction counters"""
+        with self._lock:
+            active = len(self._active)
+        return {
+            'root': str(self.root),
+            'usage_bytes': self.last_usage,
+            'quota_bytes': self.quota_bytes,
+            'active_dirs': active,
+            'evicted_dirs': self.evicted_dirs,
+            'evicted_bytes': self.evicted_bytes,
+            'last_sweep': self.last_sweep,
+        }
+
+class ResultStore:
+    """Content-addressed, size-bounded LRU store of finished downloads"""
+    
+    def __init__(self, root, max_bytes=1024 ** 3):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (path, size)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.attached = 0
+        self.evictions = 0
+        
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._load_existing()
+    
+    @staticmethod
+    def make_key(url, plan):
+        """Key a result by video ID, resolved format spec and post-processing plan"""
+        raw = '|'.join([
+            MetadataCache.normalize_key(url), plan['format_id'], plan['action'], plan['target'],
+            str(plan.get('audio_bitrate') or '')
+        ])
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+    
+    def _load_existing(self):
+        """Index results kept from earlier runs, oldest first"""
+        found = []
+        for entry_dir in self.root.iterdir():
+            files = [path for path in entry_dir.iterdir() if path.is_file()] if entry_dir.is_dir() else []
+            if len(files) != 1:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            stat = files[0].stat()
+            found.append((stat.st_mtime, entry_dir.name, str(files[0]), stat.st_size))
+        for _, key, path, size in sorted(found):
+            self._entries[key] = (path, size)
+            self._size += size
+        self._evict()
+    
+    def get(self, key):
+        """Return the stored file for a key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and not os.path.exists(entry[0]):
+                del self._entries[key]
+                self._size -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, key, path):
+        """Move a finished file into the store and return its new path"""
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            return path
+        
+        entry_dir = self.root / key
+        entry_dir.mkdir(exist_ok=True)
+        stored = str(entry_dir / os.path.basename(path))
+        shutil.move(path, stored)
+        
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (stored, size)
+            self._size += size
+            self._evict()
+        return stored
+    
+    def touch(self, keys):
+        """Mark stored keys as recently used, least recent first"""
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+    
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            key, (_, size) = self._entries.popitem(last=False)
+            shutil.rmtree(self.root / key, ignore_errors=True)
+            self._size -= size
+            self.evictions += 1
+    
+    def stats(self):
+        """Return hit rate and usage"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'attached': self.attached,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+class HistoryStore:
+    """Persistent record of finished jobs and extracted metadata (SQLite in WAL mode)
+    
+    Writes go through one background thread so download workers and the UI
+    never wait on the database or on hashing a finished file.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS downloads (
+            id INTEGER PRIMARY KEY,
+            job_id TEXT,
+            video_id TEXT NOT NULL,
+            url TEXT NOT NULL,
+            title TEXT,
+            format_id TEXT,
+            options TEXT NOT NULL DEFAULT '',
+            result_key TEXT,
+            status TEXT NOT NULL,
+            path TEXT,
+            size INTEGER,
+            sha256 TEXT,
+            error TEXT,
+            cache_hit INTEGER NOT NULL DEFAULT 0,
+            created_at REAL,
+            started_at REAL,
+            finished_at REAL NOT NULL,
+            seconds REAL,
+            spans TEXT
+        );
+        CREATE INDEX IF NOT EXISTS downloads_video ON downloads (video_id, finished_at);
+        CREATE INDEX IF NOT EXISTS downloads_url ON downloads (url);
+        CREATE INDEX IF NOT EXISTS downloads_finished ON downloads (finished_at);
+        CREATE INDEX IF NOT EXISTS downloads_result ON downloads (result_key);
+        CREATE INDEX IF NOT EXISTS downloads_path ON downloads (path);
+        CREATE TABLE IF NOT EXISTS videos (
+            video_id TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            info TEXT NOT NULL,
+            fetched_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS videos_fetched ON videos (fetched_at);
+    """
+    # Columns added after the first release of the schema; databases get any missing ones on open
+    ADDED_COLUMNS = (
+        ('download_bytes', 'INTEGER'),
+        ('download_seconds', 'REAL'),
+        ('budget_seconds', 'REAL'),
+        ('budget_mb', 'REAL'),
+        ('predicted_bytes', 'INTEGER'),
+        ('predicted_seconds', 'REAL'),
+    )
+    # Extracted format URLs expire upstream after a few hours anyway
+    INFO_RETENTION = 24 * 3600
+    
+    def __init__(self, path, max_rows=100000):
+        self.path = str(path)
+        self.max_rows = max_rows
+        self._local = threading.local()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history-writer')
+        self._lock = threading.Lock()
+        self._queued = 0
+        self.writes = 0
+        self.failed_writes = 0
+        
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connect()
+        # WAL lets the UI read pages while the writer thread commits
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(self.SCHEMA)
+        existing = {row['name'] for row in conn.execute("PRAGMA table_info(downloads)")}
+        with conn:
+            for name, sql_type in self.ADDED_COLUMNS:
+                if name not in existing:
+                    conn.execute(f"ALTER TABLE downloads ADD COLUMN {name} {sql_type}")
+        self._prune()
+    
+    def _connect(self):
+        """This thread's connection; sqlite3 connections must not cross threads"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+    
+    def _write(self, fn, *args):
+        with self._lock:
+            self._queued += 1
+        future = self._writer.submit(fn, *args)
+        future.add_done_callback(self._written)
+        return future
+    
+    def _written(self, future):
+        with self._lock:
+            self._queued -= 1
+        if future.exception() is not None:
+            self.failed_writes += 1
+            logger.warning("History write failed: %s", future.exception())
+        else:
+            self.writes += 1
+    
+    def flush(self, timeout=None):
+        """Wait until every queued write has been committed"""
+        self._writer.submit(lambda: None).result(timeout)
+    
+    @staticmethod
+    def options_key(options):
+        return json.dumps(options, sort_keys=True) if options else ''
+    
+    @staticmethod
+    def checksum(path, chunk_size=1024 * 1024):
+        """SHA-256 of a file, read in chunks"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    def record(self, job):
+        """Queue a finished job snapshot for writing"""
+        return self._write(self._insert_job, job)
+    
+    def _insert_job(self, job):
+        conn = self._connect()
+        path = job['filename'] if job['status'] == DownloadJob.DONE else None
+        size = digest = None
+        if path and os.path.isfile(path):
+            size = os.path.getsize(path)
+            # Results are immutable once stored: a cache hit reuses the earlier hash
+            row = conn.execute(
+                "SELECT sha256 FROM downloads WHERE path = ? AND size = ? AND sha256 IS NOT NULL "
+                "ORDER BY id DESC LIMIT 1", (path, size)).fetchone()
+            if row:
+                digest = row['sha256']
+            else:
+                started = time.perf_counter()
+                digest = self.checksum(path)
+                metrics.observe('checksum', time.perf_counter() - started, job_id=job['id'])
+        
+        started_at = job['started_at'] or job['created_at']
+        transfer = sum(span['seconds'] for span in job['spans'] if span['stage'] == 'download')
+        prediction = job['prediction'] or {}
+        with conn:
+            conn.execute(
+                "INSERT INTO downloads (job_id, video_id, url, title, format_id, options, result_key, "
+                "status, path, size, sha256, error, cache_hit, created_at, started_at, finished_at, "
+                "seconds, spans, download_bytes, download_seconds, budget_seconds, budget_mb, "
+                "predicted_bytes, predicted_seconds) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job['id'], MetadataCache.normalize_key(job['url']), job['url'], job['title'],
+                 job['format_id'], self.options_key(job['options']), job['result_key'], job['status'],
+                 path, size, digest, job['error'], int(job['cache_hit']), job['created_at'],
+                 job['started_at'], job['finished_at'], job['finished_at'] - started_at,
+                 json.dumps(job['spans']), job['downloaded_bytes'] or None, transfer or None,
+                 prediction.get('budget_seconds'), prediction.get('budget_mb'),
+                 prediction.get('predicted_bytes'), prediction.get('predicted_seconds')))
+    
+    def record_info(self, video_id, url, info):
+        """Queue extracted (slimmed) metadata for writing"""
+        return self._write(self._insert_info, video_id, url, json.dumps(info, default=str), time.time())
+    
+    def _insert_info(self, video_id, url, info_json, fetched_at):
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO videos (video_id, url, info, fetched_at) VALUES (?, ?, ?, ?)",
+                         (video_id, url, info_json, fetched_at))
+    
+    @staticmethod
+    def _row(row):
+        record = dict(row)
+        record['spans'] = json.loads(record['spans'] or '[]')
+        record['cache_hit'] = bool(record['cache_hit'])
+        return record
+    
+    @staticmethod
+    def _where(conditions, status=None, job_ids=None):
+        """WHERE clause and arguments for the optional status and job ID filters"""
+        conditions = list(conditions)
+        if status:
+            conditions.append(("status = ?", (status,)))
+        if job_ids is not None:
+            # One bound JSON array instead of a placeholder per ID
+            conditions.append(("job_id IN (SELECT value FROM json_each(?))", (json.dumps(list(job_ids)),)))
+        if not conditions:
+            return "", ()
+        return ("WHERE " + " AND ".join(f"({clause})" for clause, _ in conditions),
+                tuple(arg for _, args in conditions for arg in args))
+    
+    def find(self, url_or_id, limit=20, job_ids=None):
+        """Most recent jobs for a video, looked up by video ID or URL, optionally only the given jobs"""
+        where, args = self._where([("video_id = ? OR url = ?",
+                                    (MetadataCache.normalize_key(url_or_id), url_or_id.strip()))],
+                                  job_ids=job_ids)
+        rows = self._connect().execute(
+            f"SELECT * FROM downloads {where} ORDER BY finished_at DESC LIMIT ?", args + (limit,)).fetchall()
+        return [self._row(row) for row in rows]
+    
+    def result_key_for(self, url, format_id, options=None):
+        """Result key of the last successful run of the same request, or None"""
+        row = self._connect().execute(
+            "SELECT result_key FROM downloads WHERE video_id = ? AND format_id = ? AND options = ? "
+            "AND status = 'done' AND result_key IS NOT NULL ORDER BY finished_at DESC LIMIT 1",
+            (MetadataCache.normalize_key(url), format_id, self.options_key(options))).fetchone()
+        return row['result_key'] if row else None
+    
+    def throughput_samples(self, limit=50, min_bytes=1):
+        """(bytes per second, overhead seconds) of recent transfers, oldest first"""
+        rows = self._connect().execute(
+            "SELECT download_bytes, download_seconds, seconds FROM downloads "
+            "WHERE status = 'done' AND cache_hit = 0 AND download_bytes >= ? AND download_seconds > 0 "
+            "ORDER BY finished_at DESC LIMIT ?", (min_bytes, limit)).fetchall()
+        return [(row['download_bytes'] / row['download_seconds'], max(row['seconds'] - row['download_seconds'], 0.0))
+                for row in reversed(rows)]
+    
+    def count(self, status=None, job_ids=None):
+        """Number of recorded jobs, optionally only those with one status or among the given jobs"""
+        where, args = self._where([], status, job_ids)
+        return self._connect().execute(f"SELECT COUNT(*) FROM downloads {where}", args).fetchone()[0]
+    
+    def page(self, page=1, page_size=20, status=None, job_ids=None):
+        """One page of jobs, newest first"""
+        where, args = self._where([], status, job_ids)
+        rows = self._connect().execute(
+            f"SELECT * FROM downloads {where} ORDER BY finished_at DESC LIMIT ? OFFSET ?",
+            args + (page_size, (max(1, page) - 1) * page_size)).fetchall()
+        return [self._row(row) for row in rows]
+    
+    def warm_metadata(self, metadata_cache):
+        """Reload extractions still within the cache TTL; returns how many"""
+        rows = self._connect().execute(
+            "SELECT url, info, fetched_at FROM videos WHERE fetched_at > ? ORDER BY fetched_at",
+            (time.time() - metadata_cache.ttl,)).fetchall()
+        for row in rows:
+            metadata_cache.put(row['url'], json.loads(row['info']), fetched_at=row['fetched_at'])
+        if rows:
+            logger.info("Warmed metadata cache with %d videos from history", len(rows))
+        return len(rows)
+    
+    def warm_results(self, results):
+        """Restore the result store's LRU order from when each result was last served"""
+        rows = self._connect().execute(
+            "SELECT result_key, MAX(finished_at) AS last_used FROM downloads "
+            "WHERE status = 'done' AND result_key IS NOT NULL GROUP BY result_key ORDER BY last_used"
+        ).fetchall()
+        results.touch(row['result_key'] for row in rows)
+        return len(rows)
+    
+    def _prune(self):
+        """Drop metadata past its usefulness and jobs beyond max_rows"""
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM videos WHERE fetched_at < ?", (time.time() - self.INFO_RETENTION,))
+            conn.execute("DELETE FROM downloads WHERE id <= (SELECT MAX(id) FROM downloads) - ?",
+                         (self.max_rows,))
+    
+    def stats(self):
+        """Return row counts, database size and write counters"""
+        conn = self._connect()
+        size = sum(os.path.getsize(self.path + suffix) for suffix in ('', '-wal')
+                   if os.path.exists(self.path + suffix))
+        return {
+            'jobs': self.count(),
+            'videos': conn.execute("SELECT COUNT(*) FROM videos").fetchone()[0],
+            'bytes': size,
+            'writes': self.writes,
+            'failed_writes': self.failed_writes,
+            'queued_writes': self._queued,
+        }
+
+class ThumbnailCache:
+    """Size-bounded LRU of downsized thumbnails on local disk, one per video ID"""
+    
+    MAX_SIZE = (320, 320)
+    
+    def __init__(self, root, max_bytes=64 * 1024 * 1024):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # video id -> (path, size)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+        
+        self.root.mkdir(parents=True, exist_ok=True)
+        found = sorted((path.stat().st_mtime, path) for path in self.root.glob('*.jpg'))
+        for _, path in found:
+            size = path.stat().st_size
+            self._entries[path.stem] = (str(path), size)
+            self._size += size
+        self._evict()
+    
+    @staticmethod
+    def pick_url(entry):
+        """Smallest listed thumbnail at least MAX_SIZE wide, else the default one"""
+        thumbnails = [t for t in entry.get('thumbnails') or [] if t.get('url')]
+        wide = [t for t in thumbnails if (t.get('width') or 0) >= ThumbnailCache.MAX_SIZE[0]]
+        if wide:
+            return min(wide, key=lambda t: t['width'])['url']
+        if entry.get('thumbnail'):
+            return entry['thumbnail']
+        return thumbnails[-1]['url'] if thumbnails else None
+    
+    @staticmethod
+    def _key(video_id):
+        key = re.sub(r'[^\w-]', '_', video_id)
+        return key if len(key) <= 64 else hashlib.sha1(key.encode('utf-8')).hexdigest()
+    
+    def get(self, video_id):
+        """Return the cached thumbnail path for a video ID, or None"""
+        key = self._key(video_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and not os.path.exists(entry[0]):
+                del self._entries[key]
+                self._size -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def fetch(self, video_id, url, timeout=10):
+        """Download, downsize and store a thumbnail; return its path"""
+        with http_sessions.session() as session:
+            response = session.get(url, timeout=timeout)
+        response.raise_for_status()
+        
+        key = self._key(video_id)
+        path = self.root / f"{key}.jpg"
+        tmp_path = self.root / f"{key}.{threading.get_ident()}.tmp"
+        try:
+            from PIL import Image
+        except ImportError:  # Cached at the original size instead
+            Image = None
+        if Image is not None:
+            with Image.open(BytesIO(response.content)) as image:
+                image.thumbnail(self.MAX_SIZE)
+                image.convert('RGB').save(tmp_path, 'JPEG', quality=85)
+        else:
+            tmp_path.write_bytes(response.content)
+        os.replace(tmp_path, path)
+        
+        size = path.stat().st_size
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (str(path), size)
+            self._size += size
+            self.fetched += 1
+            self._evict()
+        return str(path)
+    
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            _, (path, size) = self._entries.popitem(last=False)
+            if os.path.exists(path):
+                os.remove(path)
+            self._size -= size
+    
+    def stats(self):
+        """Return hit rate and usage"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'fetched': self.fetched,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+class Prefetcher:
+    """Fetch metadata and thumbnails in the background so pages render without waiting"""
+    
+    def __init__(self, metadata_cache, thumbnails, workers=4, ydl_pool=None):
+        self.metadata_cache = metadata_cache
+        self.thumbnails = thumbnails
+        self.ydl_pool = ydl_pool
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self._pending = {}  # task key -> Future
+        self._failed_at = {}  # task key -> time of the last failure
+        self._lock = threading.Lock()
+        self.failed = 0
+        self.ydl_opts = {
+            'quiet': True,
+            'no_warnings': True,
+            'skip_download': True,
+            'http_headers': {
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+            }
+        }
+    
+    RETRY_AFTER = 300
+    
+    def _submit(self, key, fn, *args):
+        """Schedule fn once per key; repeated calls return the in-flight future"""
+        with self._lock:
+            if time.time() - self._failed_at.get(key, 0) < self.RETRY_AFTER:
+                # Don't hammer a URL that just failed on every rerun
+                return None
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            future = self._pool.submit(fn, *args)
+            self._pending[key] = future
+        # Outside the lock: a future that already finished runs _done inline, which takes it
+        future.add_done_callback(lambda f: self._done(key, f))
+        return future
+    
+    def _done(self, key, future):
+        with self._lock:
+            self._pending.pop(key, None)
+            if future.exception() is not None:
+                self._failed_at[key] = time.time()
+                self.failed += 1
+                logger.debug("Prefetch %s failed: %s", key, future.exception())
+    
+    def pending(self):
+        """Number of fetches queued or running"""
+        with self._lock:
+            return len(self._pending)
+    
+    def _extract(self, url):
+        with (self.ydl_pool.acquire(self.ydl_opts) if self.ydl_pool else yt_dlp.YoutubeDL(self.ydl_opts)) as ydl:
+            info = ydl.extract_info(url, download=False)
+        info = self.metadata_cache.put(url, info) if info else info
+        if info:
+            self.thumbnail(info)
+        return info
+    
+    def info(self, url, wait=0):
+        """Cached metadata for a URL; otherwise schedule extraction and wait up to `wait` seconds"""
+        cached = self.metadata_cache.get(url)
+        if cached is not None:
+            return cached
+        future = self._submit(('info', MetadataCache.normalize_key(url)), self._extract, url)
+        if future and wait:
+            try:
+                return future.result(timeout=wait)
+            except Exception:
+                return None
+        return None
+    
+    def thumbnail(self, entry, wait=0):
+        """Cached thumbnail path for a video entry or info dict; fetched in the background on a miss"""
+        video_id = entry.get('id') or (MetadataCache.normalize_key(entry['url']) if entry.get('url') else None)
+        if not video_id:
+            return None
+        cached = self.thumbnails.get(video_id)
+        if cached:
+            return cached
+        url = ThumbnailCache.pick_url(entry)
+        if not url:
+            return None
+        future = self._submit(('thumb', video_id), self.thumbnails.fetch, video_id, url)
+        if future and wait:
+            try:
+                return future.result(timeout=wait)
+            except Exception:
+                return None
+        return None
+    
+    def prefetch_entries(self, entries, with_info=True):
+        """Warm thumbnails (and optionally full metadata) for upcoming list entries"""
+        for entry in entries:
+            self.thumbnail(entry)
+            if with_info:
+                self.info(entry['url'])
+
+class HTTPSessionPool:
+    """Idle requests sessions shared across downloads so their keep-alive connections get reused"""
+    
+    def __init__(self, max_idle=16):
+        self.max_idle = max_idle
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+    
+    @contextmanager
+    def session(self):
+        """Check out a session for the calling thread's exclusive use"""
+        with self._lock:
+            session = self._idle.pop() if self._idle else None
+            if session is None:
+                self.created += 1
+            else:
+                self.reused += 1
+        session = session or requests.Session()
+        try:
+            yield session
+        finally:
+            with self._lock:
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(session)
+                    session = None
+            if session is not None:
+                session.close()
+    
+    def stats(self):
+        """Return session counts"""
+        with self._lock:
+            return {'idle': len(self._idle), 'created': self.created, 'reused': self.reused}
+
+# Process-wide: range chunks, HEAD probes and thumbnails all draw from it
+http_sessions = HTTPSessionPool()
+metrics.register('http_sessions', http_sessions.stats)
+
+class RangeDownloader:
+    """Fetch one progressive HTTP stream over parallel byte-range connections, resumably"""
+    
+    def __init__(self, connections=4, chunk_size=8 * 1024 * 1024, retries=3, timeout=30, sessions=None):
+        self.connections = max(1, connections)
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+        self.sessions = sessions or http_sessions
+    
+    def _load_state(self, state_path, total_size):
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+            if state.get('size') == total_size and state.get('chunk_size') == self.chunk_size:
+                return set(state.get('done', []))
+        except (OSError, ValueError):
+            pass
+        return set()
+    
+    def _save_state(self, state_path, total_size, done):
+        tmp_path = state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'size': total_size, 'chunk_size': self.chunk_size, 'done': sorted(done)}, f)
+        os.replace(tmp_path, state_path)
+    
+    def fetch(self, url, dest, total_size, headers=None, progress_callback=None, cancel_event=None):
+        """Download url into dest, resuming finished chunks recorded next to it"""
+        # Own suffix: yt-dlp must never mistake this sparse, preallocated file for its .part
+        part_path = dest + '.rpart'
+        state_path = dest + '.ranges'
+        chunk_count = max(1, -(-total_size // self.chunk_size))
+        if os.path.exists(dest) and os.path.getsize(dest) == total_size:
+            return dest
+        
+        done = self._load_state(state_path, total_size) if os.path.exists(part_path) else set()
+        with open(part_path, 'ab') as f:
+            f.truncate(total_size)
+        
+        lock = threading.Lock()
+        chunk_bytes = {index: self._chunk_range(index, total_size)[2] for index in done}
+        
+        def report():
+            if progress_callback:
+                progress_callback(sum(chunk_bytes.values()), total_size)
+        
+        def fetch_chunk(index, fd):
+            start, end, length = self._chunk_range(index, total_size)
+            for attempt in range(self.retries + 1):
+                with lock:
+                    chunk_bytes[index] = 0
+                try:
+                    with self.sessions.session() as session, session.get(
+                            url, headers={**(headers or {}), 'Range': f'bytes={start}-{end}'},
+                            stream=True, timeout=self.timeout) as response:
+                        if response.status_code != 206:
+                            raise RuntimeError(f"server ignored range request (HTTP {response.status_code})")
+                        offset = start
+                        for data in response.iter_content(256 * 1024):
+                            if cancel_event is not None and cancel_event.is_set():
+                                raise yt_dlp.utils.DownloadCancelled('Cancelled by user')
+                            os.pwrite(fd, data, offset)
+                            offset += len(data)
+                            with lock:
+                                chunk_bytes[index] = offset - start
+                            report()
+                    if offset - start != length:
+                        raise IOError(f"chunk {index} incomplete ({offset - start}/{length} bytes)")
+                    with lock:
+                        done.add(index)
+                        self._save_state(state_path, total_size, done)
+                    return
+                except yt_dlp.utils.DownloadCancelled:
+                    raise
+                except Exception:
+                    if attempt >= self.retries:
+                        raise
+                    time.sleep(2 ** attempt)
+        
+        pending = [index for index in range(chunk_count) if index not in done]
+        fd = os.open(part_path, os.O_WRONLY)
+        try:
+            report()
+            with ThreadPoolExecutor(max_workers=self.connections, thread_name_prefix='range') as pool:
+                futures = [pool.submit(fetch_chunk, index, fd) for index in pending]
+                for future in futures:
+                    future.result()
+        finally:
+            os.close(fd)
+        
+        os.replace(part_path, dest)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        return dest
+    
+    def probe_size(self, url, headers=None):
+        """Content length of a URL from a HEAD request, or None"""
+        try:
+            with self.sessions.session() as session:
+                response = session.head(url, headers=headers, allow_redirects=True, timeout=self.timeout)
+            length = int(response.headers.get('Content-Length') or 0)
+            if response.ok and length:
+                return length
+        except (requests.RequestException, ValueError):
+            pass
+        return None
+    
+    def _chunk_range(self, index, total_size):
+        start = index * self.chunk_size
+        end = min(start + self.chunk_size, total_size) - 1
+        return start, end, end - start + 1
+
+class ProgressAggregator:
+    """Coalesce yt-dlp hook events into one smoothed, rate-limited progress value"""
+    
+    # Share of the bar reserved for merging/remuxing/converting
+    POSTPROCESS_WEIGHT = 0.05
+    
+    def __init__(self, streams=None, postprocessing=False, max_hz=4.0, smoothing=0.3):
+        self.min_interval = 1.0 / max_hz if max_hz else 0.0
+        self.smoothing = smoothing
+        self.postprocess_weight = self.POSTPROCESS_WEIGHT if postprocessing else 0.0
+        # stream key -> [downloaded, total]; pre-seeded with expected sizes
+        self._streams = OrderedDict(
+            (stream['format_id'], [0, stream.get('size') or 0]) for stream in streams or []
+        )
+        self._lock = threading.Lock()
+        self.phase = 'starting'
+        self.filename = ''
+        self.speed = 0.0
+        self._last_sample = None
+        self._last_emit = 0.0
+        self._postprocess_done = 0.0
+    
+    @staticmethod
+    def _stream_key(d):
+        return (d.get('info_dict') or {}).get('format_id') or d.get('filename') or 'default'
+    
+    def on_download(self, d):
+        """Record a yt-dlp progress hook event; return True if an update should be sent"""
+        with self._lock:
+            key = self._stream_key(d)
+            stream = self._streams.setdefault(key, [0, 0])
+            previous_phase = self.phase
+            
+            if d['status'] == 'downloading':
+                self.phase = 'downloading'
+                stream[0] = d.get('downloaded_bytes') or 0
+                total = d.get('total_bytes') or d.get('total_bytes_estimate')
+                if total:
+                    stream[1] = max(total, stream[0])
+                self.filename = d.get('filename', self.filename)
+                self._sample_speed()
+            elif d['status'] == 'finished':
+                stream[0] = stream[1] = max(stream[0], stream[1], d.get('total_bytes') or 0,
+                                            d.get('downloaded_bytes') or 0)
+                self.filename = d.get('filename', self.filename)
+            
+            return self._should_emit(force=self.phase != previous_phase or d['status'] == 'finished')
+    
+    def on_postprocess(self, d):
+        """Record a yt-dlp postprocessor hook event"""
+        with self._lock:
+            previous_phase = self.phase
+            if d['status'] == 'started':
+                self.phase = 'processing'
+            elif d['status'] == 'finished':
+                self._postprocess_done = 1.0
+            return self._should_emit(force=self.phase != previous_phase)
+    
+    def finish(self, filename=None):
+        with self._lock:
+            self.phase = 'finished'
+            self._postprocess_done = 1.0
+            for stream in self._streams.values():
+                stream[0] = stream[1] = max(stream)
+            if filename:
+                self.filename = filename
+    
+    def _sample_speed(self):
+        downloaded = sum(stream[0] for stream in self._streams.values())
+        now = time.time()
+        if self._last_sample is None:
+            self._last_sample = (now, downloaded)
+            return
+        
+        last_time, last_downloaded = self._last_sample
+        elapsed = now - last_time
+        if elapsed < 0.2:
+            return
+        # Fragment and stream switches can report a lower count; ignore those deltas
+        instant = max(downloaded - last_downloaded, 0) / elapsed
+        self.speed = instant if not self.speed else (
+            self.smoothing * instant + (1 - self.smoothing) * self.speed)
+        self._last_sample = (now, downloaded)
+    
+    def _should_emit(self, force=False):
+        now = time.time()
+        if force or now - self._last_emit >= self.min_interval:
+            self._last_emit = now
+            return True
+        return False
+    
+    def snapshot(self):
+        """Return the combined progress as a plain dict"""
+        with self._lock:
+            downloaded = sum(stream[0] for stream in self._streams.values())
+            total = sum(stream[1] for stream in self._streams.values())
+            if self._streams and all(stream[1] for stream in self._streams.values()):
+                fraction = downloaded / total
+            else:
+                # Some stream sizes unknown: weigh each stream equally
+                fractions = [stream[0] / stream[1] if stream[1] else 0.0
+                             for stream in self._streams.values()]
+                fraction = sum(fractions) / len(fractions) if fractions else 0.0
+            
+            progress = (min(fraction, 1.0) * (1 - self.postprocess_weight)
+                        + self._postprocess_done * self.postprocess_weight) * 100
+            remaining = max(total - downloaded, 0)
+            eta = int(remaining / self.speed) if self.speed and total else 0
+            return {
+                'status': self.phase,
+                'progress': 100.0 if self.phase == 'finished' else progress,
+                'speed': self.speed,
+                'eta': eta,
+                'downloaded_bytes': downloaded,
+                'total_bytes': total,
+                'filename': self.filename,
+            }
+
+class PostProcessStage:
+    """Bounded pool of ffmpeg workers, sized to the CPU, for merge/remux/transcode tasks"""
+    
+    # Encoders used when codecs have to change for the target container
+    TRANSCODE_CODECS = {
+        'mp4': (['-c:v', 'libx264', '-preset', 'veryfast'], ['-c:a', 'aac']),
+        'webm': (['-c:v', 'libvpx-vp9', '-row-mt', '1'], ['-c:a', 'libopus']),
+    }
+    
+    # Encoders for audio-only targets, with the settings used for 'best' quality; lossy ones
+    # honour a requested bitrate instead, lossless ones (None) need neither
+    AUDIO_CODECS = {
+        'mp3': (['-c:a', 'libmp3lame'], ['-q:a', '0']),
+        # The native AAC encoder has no dependable VBR mode
+        'm4a': (['-c:a', 'aac'], ['-b:a', '256k']),
+        'ogg': (['-c:a', 'libvorbis'], ['-q:a', '8']),
+        'flac': (['-c:a', 'flac'], None),
+        'wav': (['-c:a', 'pcm_s16le'], None),
+    }
+    
+    def __init__(self, workers=None):
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+        self.workers = workers or max(1, cores // 2)
+        # Split the cores between concurrent ffmpeg processes instead of oversubscribing
+        self.threads_per_task = max(1, cores // self.workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='postprocess')
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+        self.cpu_seconds = 0.0
+    
+    def submit(self, task):
+        """Queue a task and return its Future"""
+        with self._lock:
+            self.queued += 1
+        return self._executor.submit(self._run, task, time.time())
+    
+    def _run(self, task, submitted_at):
+        started = time.time()
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.wait_seconds += started - submitted_at
+        metrics.observe('postprocess_wait', started - submitted_at,
+                        job_id=task.get('job_id'), spans=task.get('spans'))
+        
+        try:
+            output = self.execute(task, self.threads_per_task)
+            with self._lock:
+                self.completed += 1
+            return output
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.run_seconds += time.time() - started
+                self.cpu_seconds += task.get('cpu_seconds') or 0.0
+    
+    @staticmethod
+    def build_command(task, output, threads=0):
+        """ffmpeg arguments for a task"""
+        command = [FFmpegManager.get_ffmpeg_path(), '-hide_banner', '-loglevel', 'error', '-y']
+        for path in task['inputs']:
+            command += ['-i', path]
+        
+        if task['op'] == 'merge':
+            command += ['-map', '0:v:0', '-map', f"{len(task['inputs']) - 1}:a:0", '-c', 'copy']
+        elif task['op'] == 'remux' and task['target'] in PostProcessStage.AUDIO_CODECS:
+            command += ['-map', '0:a:0', '-vn', '-c:a', 'copy']
+        elif task['op'] == 'remux':
+            command += ['-map', '0', '-c', 'copy']
+        elif task['op'] == 'transcode' and task['target'] in PostProcessStage.AUDIO_CODECS:
+            audio_args, best_args = PostProcessStage.AUDIO_CODECS[task['target']]
+            command += ['-map', '0:a:0', '-vn'] + audio_args
+            if best_args and task.get('audio_bitrate'):
+                command += ['-b:a', f"{task['audio_bitrate']}k"]
+            elif best_args:
+                # Without a rate the encoder default (128k for mp3) would undercut the source
+                command += best_args
+        elif task['op'] == 'transcode':
+            video_args, audio_args = PostProcessStage.TRANSCODE_CODECS.get(task['target'], ([], []))
+            command += video_args + audio_args
+            if threads:
+                command += ['-threads', str(threads)]
+        else:
+            raise ValueError(f"Unknown post-processing op: {task['op']}")
+        return command + [output]
+    
+    @staticmethod
+    def execute(task, threads=0):
+        """Run a task in the calling thread and return the output path"""
+        if not FFmpegManager.get_ffmpeg_path():
+            raise RuntimeError("ffmpeg not available")
+        
+        output = task['output']
+        stem, ext = os.path.splitext(output)
+        # Write next to the output first; inputs may share its name
+        tmp_output = f"{stem}.pp-tmp{ext}"
+        started = time.time()
+        
+        process = subprocess.Popen(PostProcessStage.build_command(task, tmp_output, threads),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        stderr = process.stderr.read().decode('utf-8', 'replace')
+        process.stderr.close()
+        if hasattr(os, 'wait4'):
+            # wait4 also reports the CPU time this ffmpeg process used
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            task['cpu_seconds'] = usage.ru_utime + usage.ru_stime
+        else:
+            process.wait()
+        
+        if process.returncode != 0:
+            if os.path.exists(tmp_output):
+                os.remove(tmp_output)
+            raise RuntimeError(f"ffmpeg {task['op']} failed: {stderr.strip()[-300:]}")
+        
+        os.replace(tmp_output, output)
+        for path in task['inputs']:
+            if path != output and os.path.exists(path):
+                os.remove(path)
+        task['seconds'] = time.time() - started
+        metrics.observe(task['op'], task['seconds'], job_id=task.get('job_id'), spans=task.get('spans'),
+                        cpu_seconds=task.get('cpu_seconds'))
+        metrics.inc('ffmpeg_cpu_seconds', task.get('cpu_seconds') or 0.0)
+        logger.info("Post-processing %s -> %s: %s in %.2fs (cpu %.2fs)", task['op'],
+                    os.path.basename(output), task.get('reason', ''), task['seconds'],
+                    task.get('cpu_seconds') or 0.0)
+        return output
+    
+    def stats(self):
+        """Return queue depth, throughput and timing counters"""
+        with self._lock:
+            done = self.completed + self.failed
+            return {
+                'workers': self.workers,
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'failed': self.failed,
+                'avg_wait_seconds': self.wait_seconds / done if done else 0.0,
+                'avg_run_seconds': self.run_seconds / done if done else 0.0,
+                'cpu_seconds': self.cpu_seconds,
+            }
+
+class YoutubeDLPool:
+    """Warm YoutubeDL instances keyed by option set, checked out by one job at a time"""
+    
+    # yt-dlp reads these per call, so they are bound on checkout instead of keying the pool
+    PER_JOB_OPTIONS = ('outtmpl', 'format', 'merge_output_format', 'playlist_items',
+                       'progress_hooks', 'postprocessor_hooks')
+    
+    def __init__(self, max_idle_per_key=4, idle_ttl=600):
+        self.max_idle_per_key = max_idle_per_key
+        self.idle_ttl = idle_ttl
+        self._idle = {}  # options key -> [(ydl, released_at)], most recent last
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+    
+    @classmethod
+    def options_key(cls, opts):
+        shared = {key: value for key, value in opts.items() if key not in cls.PER_JOB_OPTIONS}
+        return json.dumps(shared, sort_keys=True, default=repr)
+    
+    @contextmanager
+    def acquire(self, opts):
+        """Yield a YoutubeDL configured with opts, reusing an idle one with the same shared options"""
+        key = self.options_key(opts)
+        with self._lock:
+            self._expire()
+            idle = self._idle.get(key)
+            ydl = idle.pop()[0] if idle else None
+            if ydl is None:
+                self.created += 1
+            else:
+                self.reused += 1
+        if ydl is None:
+            ydl = yt_dlp.YoutubeDL(dict(opts))
+        else:
+            self._bind(ydl, opts)
+        
+        reusable = False
+        try:
+            yield ydl
+            reusable = True
+        except yt_dlp.utils.YoutubeDLError:
+            # Extraction/download errors leave the instance itself intact
+            reusable = True
+            raise
+        finally:
+            self._release(key, ydl, reusable)
+    
+    @staticmethod
+    def _bind(ydl, opts):
+        """Point a pooled instance at this job's output template, format and hooks"""
+        for key in ('outtmpl', 'format', 'merge_output_format', 'playlist_items'):
+            if key in opts:
+                ydl.params[key] = opts[key]
+            else:
+                ydl.params.pop(key, None)
+        ydl._parse_outtmpl()
+        fmt = ydl.params.get('format')
+        ydl.format_selector = (fmt if fmt in (None, '-') or callable(fmt)
+                               else ydl.build_format_selector(fmt))
+        ydl._progress_hooks = list(opts.get('progress_hooks') or [])
+        ydl._postprocessor_hooks = list(opts.get('postprocessor_hooks') or [])
+    
+    def _release(self, key, ydl, reusable):
+        # Drop job hooks so idle instances don't keep finished jobs alive
+        ydl._progress_hooks = []
+        ydl._postprocessor_hooks = []
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if reusable and len(idle) < self.max_idle_per_key:
+                idle.append((ydl, time.time()))
+                return
+            self.discarded += 1
+        ydl.close()
+    
+    def _expire(self):
+        now = time.time()
+        for key, idle in list(self._idle.items()):
+            fresh = [(ydl, at) for ydl, at in idle if now - at <= self.idle_ttl]
+            for ydl, at in idle:
+                if now - at > self.idle_ttl:
+                    ydl.close()
+                    self.discarded += 1
+            if fresh:
+                self._idle[key] = fresh
+            else:
+                del self._idle[key]
+    
+    def stats(self):
+        """Return pool usage counters"""
+        with self._lock:
+            lookups = self.created + self.reused
+            return {
+                'idle': sum(len(idle) for idle in self._idle.values()),
+                'option_sets': len(self._idle),
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+                'reuse_rate': self.reused / lookups if lookups else 0.0,
+            }
+
+class YouTubeDownloader:
+    def __init__(self, output_path=None, metadata_cache=None, connections=1,
+                 chunk_size=8 * 1024 * 1024, max_attempts=3, parallel_streams=True, ydl_pool=None):
+        self.output_path = output_path or tempfile.mkdtemp()
+        self.metadata_cache = metadata_cache
+        # Without a pool every call builds (and tears down) its own YoutubeDL
+        self.ydl_pool = ydl_pool
+        self.last_error = None
+        # connections > 1 enables parallel byte-range fetching of progressive formats
+        self.connections = connections
+        self.chunk_size = chunk_size
+        # Fetch the video and audio of "video+audio" selections at the same time
+        self.parallel_streams = parallel_streams
+        self.max_attempts = max_attempts
+        self.setup_ydl_opts()
+    
+    def setup_ydl_opts(self):
+        """Setup yt-dlp options with HD support"""
+        ffmpeg_path = FFmpegManager.get_ffmpeg_path()
+        
+        self.base_opts = {
+            'quiet': False,
+            'no_warnings': False,
+            'extract_flat': False,
+            # Keep .part files and resume them on retry or after a restart
+            'continuedl': True,
+            'retries': 10,
+            'fragment_retries': 10,
+            # Enable merging of video and audio for HD formats
+            'format': 'best[height<=1080]/best',
+            'merge_output_format': 'mp4',
+            # Prefer free formats
+            'prefer_free_formats': True,
+            # Add headers to avoid some blocks
+            'http_headers': {
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+            }
+        }
+        
+        if ffmpeg_path:
+            self.base_opts['ffmpeg_location'] = ffmpeg_path
+            # Post-processing is planned per download by PostProcessPlanner
+    
+    def _ydl(self, opts):
+        """YoutubeDL context for opts, pooled when a pool is configured"""
+        if self.ydl_pool:
+            return self.ydl_pool.acquire(opts)
+        return yt_dlp.YoutubeDL(opts)
+    
+    def get_video_info(self, url):
+        """Get comprehensive video information"""
+        if self.metadata_cache:
+            cached = self.metadata_cache.get(url)
+            if cached is not None:
+                return cached
+        
+        try:
+            ydl_opts = {**self.base_opts, 'skip_download': True}
+            
+            with metrics.span('extract'), self._ydl(ydl_opts) as ydl:
+                info = ydl.extract_info(url, download=False)
+                if self.metadata_cache and info:
+                    info = self.metadata_cache.put(url, info)
+                return info
+        except Exception as e:
+            logger.warning("Error extracting video info for %s: %s", url, e)
+            self.last_error = str(e)
+            return None
+    
+    def get_available_formats(self, info, max_height=None, container=None):
+        """Get and organize available formats with HD support"""
+        if not info or 'formats' not in info:
+            return {'video': [], 'audio': [], 'combined': []}
+        
+        index = FormatIndex.for_info(info)
+        can_merge = FFmpegManager.can_merge()
+        
+        # Combined video+audio formats (older/lower quality, usually ≤720p)
+        combined_formats = [{
+            'format_id': record.format_id,
+            'quality': f"{record.height}p",
+            'height': record.height,
+            'ext': record.ext,
+            'fps': record.fps,
+            'filesize': record.filesize,
+            'type': 'combined',
+            'display': f"{record.height}p Combined ({record.ext}) - {self.format_bytes(record.filesize)}"
+        } for record in index.best_per_height(FormatRecord.COMBINED, min(max_height or 720, 720), container)]
+        
+        # High-quality video-only formats (need ffmpeg to merge audio)
+        video_formats = []
+        if can_merge:
+            video_formats = [{
+                # Create format specifier for video+best audio
+                'format_id': f"{record.format_id}+bestaudio",
+                'quality': f"{record.height}p",
+                'height': record.height,
+                'ext': record.ext,
+                'fps': record.fps,
+                'filesize': record.filesize,
+                'vcodec': record.vcodec[:15],
+                'type': 'video+audio',
+                'display': f"{record.height}p HD ({record.ext}) - {self.format_bytes(record.filesize)} + Audio"
+            } for record in index.best_per_height(FormatRecord.VIDEO, max_height, container)]
+        
+        # Audio-only formats, one per bitrate and container
+        audio_formats = []
+        seen_audio = set()
+        for record in index.query(kind=FormatRecord.AUDIO):
+            quality_key = (int(record.abr), record.ext)
+            if not record.abr or quality_key in seen_audio:
+                continue
+            seen_audio.add(quality_key)
+            audio_formats.append({
+                'format_id': record.format_id,
+                'quality': f"{int(record.abr)}kbps",
+                'abr': record.abr,
+                'ext': record.ext,
+                'filesize': record.filesize,
+                'acodec': record.acodec[:15],
+                'type': 'audio',
+                'display': f"Audio {int(record.abr)}kbps ({record.ext}) - {self.format_bytes(record.filesize)}"
+            })
+        
+        # Add some preset format options for convenience
+        preset_formats = []
+        if (max_height is None or max_height >= 1080) and any(fmt['height'] >= 1080 for fmt in video_formats):
+            preset_formats.append({
+                'format_id': 'best[height<=1080]',
+                'quality': 'Best ≤1080p',
+                'ext': 'mp4',
+                'type': 'preset',
+                'display': 'Best quality ≤1080p (Recommended)'
+            })
+        
+        preset_formats.append({
+            'format_id': 'best[height<=720]',
+            'quality': 'Best ≤720p',
+            'ext': 'mp4', 
+            'type': 'preset',
+            'display': 'Best quality ≤720p (Fast)'
+        })
+        
+        return {
+            'preset': preset_formats,
+            'video': video_formats[:15],  # Top 15 video formats
+            'combined': combined_formats[:5],  # Top 5 combined formats
+            'audio': audio_formats[:8]    # Top 8 audio formats
+        }
+    
+    @staticmethod
+    def parse_max_quality(max_quality):
+        """Height limit from the sidebar's "Maximum Quality" label, or None"""
+        match = re.search(r'(\d+)p', max_quality or '')
+        return int(match.group(1)) if match else None
+    
+    @staticmethod
+    def parse_prefer_format(prefer_format):
+        """Container from the sidebar's "Prefer Format" label, or None for any"""
+        return {'MP4 (Recommended)': 'mp4', 'WebM': 'webm'}.get(prefer_format)
+    
+    @staticmethod
+    def build_format_spec(download_type, max_quality):
+        """Build a format spec from sidebar settings for unattended downloads"""
+        max_height = YouTubeDownloader.parse_max_quality(max_quality)
+        height_filter = f"[height<={max_height}]" if max_height else ''
+        
+        if download_type == "Audio Only":
+            return 'bestaudio/best'
+        if download_type == "Video Only":
+            return f'bestvideo{height_filter}/best{height_filter}'
+        if FFmpegManager.can_merge():
+            return f'bestvideo{height_filter}+bestaudio/best{height_filter}/best'
+        return f'best{height_filter}/best'
+    
+    def expand_entries(self, url, playlist_items=None):
+        """Expand a video or playlist URL into flat entries without full extraction"""
+        ydl_opts = {
+            **self.base_opts,
+            'skip_download': True,
+            'extract_flat': 'in_playlist',
+            'quiet': True,
+        }
+        if playlist_items:
+            ydl_opts['playlist_items'] = playlist_items
+        
+        with self._ydl(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+        
+        if not info:
+            return []
+        if info.get('_type') != 'playlist':
+            # A single video was fully extracted; keep it for the download step
+            if self.metadata_cache:
+                info = self.metadata_cache.put(url, info)
+            return [{
+                'url': info.get('webpage_url') or url,
+                'title': info.get('title') or url,
+                'id': info.get('id'),
+                'thumbnail': info.get('thumbnail'),
+                'duration': info.get('duration'),
+            }]
+        
+        entries = []
+        for entry in info.get('entries') or []:
+            if not entry:
+                continue
+            entry_url = entry.get('url') or entry.get('webpage_url')
+            if entry_url and not entry_url.startswith('http') and entry.get('id'):
+                entry_url = f"https://www.youtube.com/watch?v={entry['id']}"
+            if entry_url:
+                entries.append({
+                    'url': entry_url,
+                    'title': entry.get('title') or entry_url,
+                    'id': entry.get('id'),
+                    'thumbnails': entry.get('thumbnails'),
+                    'duration': entry.get('duration'),
+                })
+        return entries
+    
+    def format_bytes(self, bytes_val):
+        """Format bytes to human readable"""
+        if not bytes_val:
+            return "Unknown size"
+        
+        for unit in ['B', 'KB', 'MB', 'GB']:
+            if bytes_val < 1024.0:
+                return f"{bytes_val:.1f} {unit}"
+            bytes_val /= 1024.0
+        return f"{bytes_val:.1f} TB"
+    
+    def fetch(self, url, format_id, custom_name=None, info=None,
+              progress_callback=None, cancel_event=None, output_path=None, max_update_hz=4.0,
+              options=None):
+        """Run the network part of a download
+        
+        Returns (success, final path or error, post-processing task or None).
+        The task still has to be executed for the final path to exist.
+        options may carry audio_format/audio_quality for an audio-only download.
+        """
+        # Remux when codecs already fit the container, transcode only if needed
+        info = info or self.get_video_info(url)
+        plan = PostProcessPlanner.plan_for(info, format_id, options)
+        logger.info("Plan for %s [%s]: %s (%s)", url, format_id, plan['action'], plan['reason'])
+        aggregator = ProgressAggregator(plan['streams'], postprocessing=plan['action'] != 'none',
+                                        max_hz=max_update_hz)
+        
+        def emit():
+            if progress_callback:
+                try:
+                    progress_callback(aggregator.snapshot())
+                except Exception:
+                    pass
+        
+        def progress_hook(d):
+            if cancel_event is not None and cancel_event.is_set():
+                raise yt_dlp.utils.DownloadCancelled('Cancelled by user')
+            if aggregator.on_download(d):
+                emit()
+        
+        def postprocessor_hook(d):
+            if aggregator.on_postprocess(d):
+                emit()
+        
+        output_dir = output_path or self.output_path
+        
+        direct = self._direct_streams(info, plan)
+        if direct:
+            try:
+                with metrics.span('download', route='direct'):
+                    path, task = self._download_direct(direct, info, plan, custom_name, output_dir,
+                                                       aggregator, cancel_event, emit)
+                metrics.inc('download_bytes', aggregator.snapshot()['downloaded_bytes'])
+                if task is None:
+                    aggregator.finish(path)
+                emit()
+                return True, path, task
+            except yt_dlp.utils.DownloadCancelled as e:
+                return False, str(e), None
+            except Exception as e:
+                logger.warning("Direct download of %s failed, falling back to yt-dlp: %s", url, e)
+        
+        # Setup download options with better format handling
+        filename_template = '%(title)s.%(ext)s'
+        if custom_name:
+            filename_template = f'{custom_name}.%(ext)s'
+        
+        components = self._merge_components(plan)
+        ydl_opts = {
+            **self.base_opts,
+            'format': plan['format_id'],
+            'outtmpl': os.path.join(output_dir, filename_template),
+            'progress_hooks': [progress_hook],
+            'postprocessor_hooks': [postprocessor_hook],
+            # Ensure we merge video+audio when needed
+            'merge_output_format': plan['merge_output_format'],
+            # Remux/convert runs afterwards as a separate post-processing task
+            'postprocessors': []
+        }
+        if components:
+            # Fetch each stream as its own file; the merge goes to the post-processing pool
+            # instead of running inside this download worker
+            ydl_opts.update({
+                'format': ','.join(components),
+                'outtmpl': os.path.join(output_dir, f"{os.path.splitext(filename_template)[0]}.f%(format_id)s.%(ext)s"),
+                'merge_output_format': None,
+            })
+        
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                with metrics.span('download', route='yt-dlp', attempt=attempt), self._ydl(ydl_opts) as ydl:
+                    result = ydl.extract_info(url, download=True)
+                break
+            except yt_dlp.utils.DownloadCancelled as e:
+                return False, str(e), None
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    return False, str(e), None
+                # .part files stay in output_dir, so the next attempt resumes
+                logger.warning("Download attempt %d/%d for %s failed: %s",
+                               attempt, self.max_attempts, url, e)
+                time.sleep(2 ** attempt)
+        
+        metrics.inc('download_bytes', aggregator.snapshot()['downloaded_bytes'])
+        if components:
+            try:
+                task = self._merge_task(result, components, plan)
+            except RuntimeError as e:
+                return False, str(e), None
+            emit()
+            return True, task['output'], task
+        
+        # Path after yt-dlp's own merge, not the intermediate stream file
+        requested = (result or {}).get('requested_downloads') or []
+        raw_path = requested[-1].get('filepath') if requested else aggregator.filename
+        task = self._postprocess_task(raw_path, plan)
+        if task is None:
+            aggregator.finish(raw_path)
+        emit()
+        return True, (task['output'] if task else raw_path), task
+    
+    @staticmethod
+    def _merge_components(plan):
+        """Format IDs to download separately and merge afterwards, or None for a single file"""
+        components = [stream['format_id'] for stream in plan['streams']]
+        if (len(components) < 2 or plan['format_id'] != '+'.join(components)
+                or not FFmpegManager.can_merge(plan['target'])):
+            return None
+        return components
+    
+    @staticmethod
+    def _merge_task(result, components, plan):
+        """Merge (or merge-and-transcode) task for separately downloaded components"""
+        # With a comma-separated format, extract_info returns one entry per component
+        entries = (result or {}).get('entries') or [result or {}]
+        paths = {}
+        for entry in entries:
+            for requested in entry.get('requested_downloads') or [entry]:
+                if requested.get('filepath'):
+                    paths[str(requested.get('format_id'))] = requested['filepath']
+        missing = [format_id for format_id in components if format_id not in paths]
+        if missing:
+            raise RuntimeError(f"yt-dlp did not report files for formats {', '.join(missing)}")
+        
+        inputs = [paths[format_id] for format_id in components]
+        suffix = f".f{components[0]}{os.path.splitext(inputs[0])[1]}"
+        stem = inputs[0][:-len(suffix)] if inputs[0].endswith(suffix) else os.path.splitext(inputs[0])[0]
+        return {
+            'op': 'merge' if plan['action'] in ('none', 'remux') else 'transcode',
+            'inputs': inputs,
+            'output': f"{stem}.{plan['target']}",
+            'target': plan['target'],
+            'reason': plan['reason'],
+        }
+    
+    @staticmethod
+    def _postprocess_task(raw_path, plan):
+        """Remux/transcode task for a downloaded file, or None if it is final as-is"""
+        if not raw_path or plan['action'] == 'none' or not plan['postprocessors']:
+            return None
+        stem, ext = os.path.splitext(raw_path)
+        if plan['action'] == 'remux' and ext.lstrip('.') == plan['target']:
+            return None
+        return {
+            'op': plan['action'],
+            'inputs': [raw_path],
+            'output': f"{stem}.{plan['target']}",
+            'target': plan['target'],
+            'reason': plan['reason'],
+            'audio_bitrate': plan.get('audio_bitrate'),
+        }
+    
+    def download(self, url, format_id, custom_name=None, info=None,
+                 progress_callback=None, cancel_event=None, output_path=None, max_update_hz=4.0,
+                 options=None):
+        """Download and post-process in the calling thread; report progress through a callback"""
+        success, result, task = self.fetch(url, format_id, custom_name, info, progress_callback,
+                                           cancel_event, output_path, max_update_hz, options)
+        if not success or task is None:
+            return success, result
+        
+        def report(status, progress):
+            if progress_callback:
+                progress_callback({'status': status, 'progress': progress, 'speed': 0, 'eta': 0,
+                                   'filename': task['output']})
+        
+        report('processing', (1 - ProgressAggregator.POSTPROCESS_WEIGHT) * 100)
+        try:
+            result = PostProcessStage.execute(task)
+        except Exception as e:
+            return False, str(e)
+        report('finished', 100.0)
+        return True, result
+    
+    def _direct_streams(self, info, plan):
+        """Return the formats to fetch directly, or None to let yt-dlp download"""
+        formats = {f.get('format_id'): f for f in (info or {}).get('formats') or []}
+        streams = [formats.get(stream['format_id']) for stream in plan['streams']]
+        if not streams or not all(fmt and fmt.get('protocol') in ('http', 'https') and fmt.get('url')
+                                  for fmt in streams):
+            return None
+        
+        if len(streams) == 1:
+            # Single file (progressive or audio-only): only worth it with several connections
+            if self.connections > 1 and streams[0].get('filesize'):
+                return streams
+            return None
+        
+        # Separate video and audio: fetch both at once, then merge with a stream copy
+        if (self.parallel_streams and len(streams) == 2 and plan['action'] in ('none', 'remux')
+                and FFmpegManager.can_merge(plan['target'])):
+            return streams
+        return None
+    
+    def _download_direct(self, streams, info, plan, custom_name, output_dir, aggregator, cancel_event, emit):
+        """Fetch progressive streams concurrently into output_dir; return (path, merge task or None)"""
+        name = custom_name or yt_dlp.utils.sanitize_filename(info.get('title') or streams[0]['format_id'])
+        fetcher = RangeDownloader(connections=max(1, self.connections), chunk_size=self.chunk_size)
+        
+        def fetch(fmt, dest):
+            headers = {**self.base_opts['http_headers'], **(fmt.get('http_headers') or {})}
+            size = fmt.get('filesize') or fetcher.probe_size(fmt['url'], headers)
+            if not size:
+                raise RuntimeError(f"unknown size for format {fmt['format_id']}")
+            
+            def on_progress(downloaded, total):
+                if aggregator.on_download({
+                    'status': 'downloading',
+                    'downloaded_bytes': downloaded,
+                    'total_bytes': total,
+                    'filename': dest,
+                    'info_dict': {'format_id': fmt['format_id']},
+                }):
+                    emit()
+            
+            return fetcher.fetch(fmt['url'], dest, size, headers=headers,
+                                 progress_callback=on_progress, cancel_event=cancel_event)
+        
+        started = time.time()
+        if len(streams) == 1:
+            fmt = streams[0]
+            dest = fetch(fmt, os.path.join(output_dir, f"{name}.{fmt.get('ext') or 'mp4'}"))
+            logger.info("Range download of %s with %d connections took %.2fs",
+                        dest, self.connections, time.time() - started)
+            task = self._postprocess_task(dest, plan)
+            return (task['output'] if task else dest), task
+        
+        parts = [os.path.join(output_dir, f"{name}.f{fmt['format_id']}.{fmt.get('ext') or 'bin'}")
+                 for fmt in streams]
+        with ThreadPoolExecutor(max_workers=len(streams), thread_name_prefix='stream') as pool:
+            futures = [pool.submit(fetch, fmt, part) for fmt, part in zip(streams, parts)]
+            for future in futures:
+                future.result()
+        
+        logger.info("Parallel fetch of %s took %.2fs",
+                    '+'.join(fmt['format_id'] for fmt in streams), time.time() - started)
+        # Merge as soon as both components are on disk
+        task = {
+            'op': 'merge',
+            'inputs': parts,
+            'output': os.path.join(output_dir, f"{name}.{plan['target']}"),
+            'target': plan['target'],
+            'reason': plan['reason'],
+        }
+        return task['output'], task
+
+class HostRateLimiter:
+    """Space out request starts per host to avoid being rate-limited"""
+    
+    def __init__(self, min_interval=1.0):
+        self.min_interval = min_interval
+        self._next_slot = {}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def host_key(url):
+        """Group URL aliases of the same service under one host"""
+        host = urlparse(url).netloc.lower()
+        for prefix in ('www.', 'm.', 'music.'):
+            if host.startswith(prefix):
+                host = host[len(prefix):]
+        return 'youtube.com' if host == 'youtu.be' else host
+    
+    def wait(self, url):
+        """Block until this host may be contacted again; return seconds waited"""
+        if self.min_interval <= 0:
+            return 0.0
+        
+        host = self.host_key(url)
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next_slot.get(host, 0.0))
+            self._next_slot[host] = slot + self.min_interval
+        
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+class DownloadJob:
+    """A single background download and its observable state"""
+    
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    FINAL_STATES = (DONE, FAILED, CANCELLED)
+    
+    def __init__(self, url, format_id, custom_name=None, title=None, batch_id=None, options=None,
+                 budget=None, prediction=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.batch_id = batch_id
+        self.options = options or {}
+        # BudgetSelector.select arguments; the format is picked per video when the job starts
+        self.budget = budget
+        self.prediction = prediction
+        self.url = url
+        self.format_id = format_id
+        self.custom_name = custom_name
+        self.title = title or url
+        self.status = self.QUEUED
+        self.phase = None
+        self.progress = 0.0
+        self.speed = 0
+        self.eta = 0
+        self.downloaded_bytes = 0
+        self.filename = ''
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self.done_event = threading.Event()
+        self.future = None
+        self.result_key = None
+        self.cache_hit = False
+        # Jobs waiting for this one's result, as (job, downloader, info), and the job this one waits for
+        self.waiters = []
+        self.waiting_on = None
+        self.spans = []  # [{'stage', 'seconds'}] in the order they finished
+    
+    @property
+    def is_active(self):
+        return self.status not in self.FINAL_STATES
+    
+    @property
+    def download_name(self):
+        """Name to save the file as; a cached result keeps whoever downloaded it first's name on disk"""
+        if not self.filename:
+            return None
+        name = self.custom_name or yt_dlp.utils.sanitize_filename(self.title or '')
+        return name + os.path.splitext(self.filename)[1] if name else os.path.basename(self.filename)
+    
+    def snapshot(self):
+        """Return a plain dict copy safe to read from the UI thread"""
+        return {
+            'id': self.id,
+            'batch_id': self.batch_id,
+            'url': self.url,
+            'format_id': self.format_id,
+            'options': dict(self.options),
+            'result_key': self.result_key,
+            'title': self.title,
+            'status': self.status,
+            'phase': self.phase,
+            'progress': self.progress,
+            'speed': self.speed,
+            'eta': self.eta,
+            'downloaded_bytes': self.downloaded_bytes,
+            'prediction': self.prediction,
+            'filename': self.filename,
+            'download_name': self.download_name,
+            'error': self.error,
+            'cache_hit': self.cache_hit,
+            'spans': list(self.spans),
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+class DownloadJobManager:
+    """Bounded worker pool running downloads outside the Streamlit script thread"""
+    
+    def __init__(self, max_workers=3, max_retained=200, rate_limiter=None, scratch=None,
+                 results=None, postprocess=None, history=None, selector=None):
+        self.max_workers = max_workers
+        self.max_retained = max_retained
+        self.rate_limiter = rate_limiter or HostRateLimiter(min_interval=0)
+        self.scratch = scratch
+        self.results = results
+        # ffmpeg work is handed to this stage so download workers go back to the network
+        self.postprocess = postprocess
+        # Every finished job is recorded here when set
+        self.history = history
+        # Picks formats for budgeted jobs and learns from finished ones
+        self.selector = selector
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='download-worker')
+        self._jobs = OrderedDict()
+        self._inflight = {}  # result key -> job producing it
+        self._lock = threading.Lock()
+    
+    def submit(self, downloader, url, format_id, custom_name=None, info=None, options=None, prediction=None):
+        """Queue a download and return its job ID
+        
+        Identical requests are served from the result store, or attached to
+        the job already producing the same result. prediction is the
+        BudgetSelector choice that format_id came from, if any.
+        """
+        title = (info or {}).get('title')
+        job = DownloadJob(url, format_id, custom_name, title, options=options, prediction=prediction)
+        
+        if self.results and info:
+            job.result_key = ResultStore.make_key(url, PostProcessPlanner.plan_for(info, format_id, options))
+            with self._lock:
+                self._jobs[job.id] = job
+                self._prune()
+                existing = self._inflight.get(job.result_key)
+                if existing is not None and not existing.cancel_event.is_set():
+                    # A job of its own, so this session keeps its name and can cancel alone
+                    existing.waiters.append((job, downloader, info))
+                    job.waiting_on = existing
+                    job.phase = 'waiting'
+                    self.results.attached += 1
+                    return job.id
+                cached = self.results.get(job.result_key)
+                if not cached:
+                    self._inflight[job.result_key] = job
+            if cached:
+                # Outside the lock: settling waiters takes it again
+                self._complete_from_cache(job, cached)
+                return job.id
+        else:
+            with self._lock:
+                self._jobs[job.id] = job
+                self._prune()
+        
+        job.future = self._executor.submit(self._run, job, downloader, info)
+        return job.id
+    
+    def _complete_from_cache(self, job, path):
+        job.cache_hit = True
+        job.filename = path
+        job.progress = 100.0
+        job.phase = 'finished'
+        job.started_at = job.finished_at = time.time()
+        job.status = DownloadJob.DONE
+        job.done_event.set()
+        if self.history:
+            self.history.record(job.snapshot())
+        metrics.inc('jobs_cache_hit')
+        logger.info("Job %s served from result store: %s", job.id, path)
+        self._settle_waiters(job)
+    
+    # _claim result for a job parked on the job already producing its result
+    ATTACHED = object()
+    
+    def _claim(self, job, downloader, info):
+        """Resolve the result key for a job; return a finished path if one exists
+        
+        Returns ATTACHED when another job is producing the same result: the
+        job is settled when that one finishes, without holding a worker.
+        """
+        if not self.results:
+            return None
+        if job.result_key is None and info is None and self.history:
+            # A finished copy of this exact request is found without extracting
+            key = self.history.result_key_for(job.url, job.format_id, job.options)
+            path = self.results.get(key) if key else None
+            if path:
+                job.result_key = key
+                return path
+        if job.result_key is None:
+            info = info or downloader.get_video_info(job.url)
+            if not info:
+                return None
+            job.result_key = ResultStore.make_key(
+                job.url, PostProcessPlanner.plan_for(info, job.format_id, job.options))
+        
+        with self._lock:
+            owner = self._inflight.setdefault(job.result_key, job)
+            if owner is not job:
+                # The owner may still be queued behind this worker: don't block on it
+                owner.waiters.append((job, downloader, info))
+                job.waiting_on = owner
+                job.phase = 'waiting'
+                self.results.attached += 1
+                return self.ATTACHED
+        return self.results.get(job.result_key)
+    
+    def _settle_waiters(self, job):
+        """Complete jobs attached to a finished job, or run them again if it produced nothing"""
+        with self._lock:
+            waiters, job.waiters = job.waiters, []
+            for waiter, _, _ in waiters:
+                waiter.waiting_on = None
+        for waiter, downloader, info in waiters:
+            if job.status == DownloadJob.DONE:
+                self._complete_from_cache(waiter, job.filename)
+            else:
+                waiter.future = self._executor.submit(self._run, waiter, downloader, info)
+    
+    def _detach(self, job):
+        """Remove a job from the waiters of the job it is attached to; False if it wasn't attached"""
+        with self._lock:
+            owner = job.waiting_on
+            if owner is None:
+                return False
+            owner.waiters = [entry for entry in owner.waiters if entry[0] is not job]
+            job.waiting_on = None
+            return True
+    
+    def submit_batch(self, downloader, entries, format_id, concurrency=2, options=None, budget=None):
+        """Queue entries as one batch running at most `concurrency` at a time
+        
+        With a budget, each entry's format is picked by the selector when it
+        starts; format_id is the fallback if no prediction can be made.
+        """
+        batch_id = uuid.uuid4().hex[:12]
+        # The same video listed twice would race on one output file
+        unique = OrderedDict((entry['url'], entry) for entry in entries)
+        jobs = [DownloadJob(entry['url'], format_id, title=entry.get('title'), batch_id=batch_id,
+                            options=options, budget=budget)
+                for entry in unique.values()]
+        with self._lock:
+            for job in jobs:
+                self._jobs[job.id] = job
+            self._prune()
+        
+        pending = deque(jobs)
+        for _ in range(max(1, min(concurrency, len(jobs)))):
+            self._dispatch_next(downloader, pending)
+        return [job.id for job in jobs]
+    
+    def _dispatch_next(self, downloader, pending):
+        """Hand the next pending batch entry to the pool, chaining on completion"""
+        with self._lock:
+            job = None
+            while pending:
+                candidate = pending.popleft()
+                if not candidate.cancel_event.is_set():
+                    job = candidate
+                    break
+        if job is None:
+            return
+        job.future = self._executor.submit(self._run, job, downloader, None)
+        job.future.add_done_callback(lambda _: self._dispatch_next(downloader, pending))
+    
+    def _run(self, job, downloader, info):
+        if job.cancel_event.is_set():
+            job.done_event.set()
+            return
+        
+        job.status = DownloadJob.RUNNING
+        job.started_at = time.time()
+        metrics.observe('queue_wait', job.started_at - job.created_at, job_id=job.id, spans=job.spans)
+        with metrics.trace(job.id, job.spans):
+            self._run_traced(job, downloader, info)
+    
+    def _run_traced(self, job, downloader, info):
+        # Extraction below is the first request to the host, so throttle before it
+        with metrics.span('rate_limit'):
+            self.rate_limiter.wait(job.url)
+        
+        if job.budget and job.prediction is None and self.selector:
+            with metrics.span('select'):
+                info = info or downloader.get_video_info(job.url)
+                prediction = self.selector.select(info, **job.budget) if info else None
+            if prediction:
+                job.format_id, job.prediction = prediction['format_id'], prediction
+        
+        try:
+            with metrics.span('lookup'):
+                cached = self._claim(job, downloader, info)
+        except Exception as e:
+            logger.warning("Result lookup failed for job %s: %s", job.id, e)
+            cached = None
+        if cached is self.ATTACHED:
+            return
+        if cached:
+            self._release_claim(job)
+            self._complete_from_cache(job, cached)
+            return
+        
+        def on_progress(download_info):
+            job.phase = download_info['status']
+            job.progress = download_info['progress']
+            job.speed = download_info['speed']
+            job.eta = download_info['eta']
+            job.downloaded_bytes = download_info.get('downloaded_bytes') or job.downloaded_bytes
+            job.filename = download_info['filename']
+        
+        output_path = None
+        if self.scratch:
+            # Same request, same directory: a retried or restarted job resumes its .part files
+            job_key = job.result_key or hashlib.sha1(f"{job.url}|{job.format_id}".encode('utf-8')).hexdigest()
+            output_path = self.scratch.job_dir(job_key)
+            self.scratch.acquire(output_path)
+        
+        try:
+            if self.scratch and not self.scratch.has_room():
+                raise RuntimeError("Scratch disk quota exceeded, try again later")
+            success, result, task = downloader.fetch(
+                job.url, job.format_id, job.custom_name, info,
+                progress_callback=on_progress, cancel_event=job.cancel_event,
+                output_path=output_path, options=job.options)
+        except Exception as e:
+            success, result, task = False, str(e), None
+        
+        if success and task is not None and not job.cancel_event.is_set():
+            job.phase = 'processing'
+            job.speed = job.eta = 0
+            task['job_id'], task['spans'] = job.id, job.spans
+            if self.postprocess:
+                future = self.postprocess.submit(task)
+                future.add_done_callback(lambda f: self._finish_postprocess(job, f, output_path))
+                return
+            try:
+                result = PostProcessStage.execute(task)
+            except Exception as e:
+                success, result = False, str(e)
+        
+        self._finish(job, success, result, output_path)
+    
+    def _finish_postprocess(self, job, future, output_path):
+        try:
+            success, result = True, future.result()
+        except Exception as e:
+            success, result = False, str(e)
+        self._finish(job, success, result, output_path)
+    
+    def _finish(self, job, success, result, output_path):
+        """Record a job's outcome and publish its file"""
+        if output_path:
+            self.scratch.release(output_path)
+        if success and self.results and job.result_key and os.path.isfile(result):
+            with metrics.span('store', job_id=job.id, spans=job.spans):
+                result = self.results.put(job.result_key, result)
+        
+        job.finished_at = time.time()
+        if job.cancel_event.is_set():
+            job.status = DownloadJob.CANCELLED
+        elif success:
+            job.progress = 100.0
+            job.phase = 'finished'
+            job.filename = result
+            job.status = DownloadJob.DONE
+        else:
+            job.error = result
+            job.status = DownloadJob.FAILED
+        self._release_claim(job)
+        job.done_event.set()
+        self._settle_waiters(job)
+        snapshot = job.snapshot()
+        if self.history:
+            self.history.record(snapshot)
+        if self.selector:
+            self.selector.observe(snapshot)
+        
+        seconds = job.finished_at - (job.started_at or job.created_at)
+        metrics.inc(f"jobs_{job.status}")
+        metrics.log({'type': 'job', 'job': job.id, 'url': job.url, 'format_id': job.format_id,
+                     'status': job.status, 'seconds': round(seconds, 3),
+                     'spans': [{**span, 'seconds': round(span['seconds'], 6)} for span in job.spans]})
+        logger.info("Job %s %s in %.1fs", job.id, job.status, seconds)
+    
+    def _release_claim(self, job):
+        with self._lock:
+            if job.result_key and self._inflight.get(job.result_key) is job:
+                del self._inflight[job.result_key]
+    
+    def _prune(self):
+        """Forget the oldest finished jobs beyond the retention limit"""
+        excess = len(self._jobs) - self.max_retained
+        for job_id in list(self._jobs):
+            if excess <= 0:
+                break
+            if not self._jobs[job_id].is_active:
+                del self._jobs[job_id]
+                excess -= 1
+    
+    def get(self, job_id):
+        """Return a snapshot of a job, or None if unknown"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        return job.snapshot() if job else None
+    
+    def list(self, job_ids):
+        """Return snapshots for the given job IDs that are still known"""
+        snapshots = [self.get(job_id) for job_id in job_ids]
+        return [snapshot for snapshot in snapshots if snapshot]
+    
+    def cancel(self, job_id):
+        """Cancel a queued job, or signal a running one to stop"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if not job or not job.is_active:
+            return False
+        job.cancel_event.set()
+        # Batch entries not yet dispatched have no future; attached jobs have no running worker
+        if job.future is None or job.future.cancel() or self._detach(job):
+            job.status = DownloadJob.CANCELLED
+            job.finished_at = time.time()
+            self._release_claim(job)
+            job.done_event.set()
+            self._settle_waiters(job)
+        return True
+    
+    def stats(self):
+        """Return job counts per state"""
+        with self._lock:
+            counts = {state: 0 for state in (DownloadJob.QUEUED, DownloadJob.RUNNING) + DownloadJob.FINAL_STATES}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+        counts['max_workers'] = self.max_workers
+        return counts
@@ -0,0 +1,14 @@
+"""Entry point: the UI in app.py plus file delivery from the same origin
+
+    streamlit run streamlit_app.py
+
+Finished files and ZIPs are streamed from disk by a route on Streamlit's own
+server, so a download costs the same memory whatever its size and needs no
+extra port or proxy. `streamlit run app.py` still works, but then files can
+only be saved through YTDL_DELIVERY_URL.
+"""
+import streamlit as st
+
+from core import same_origin
+
+app = st.App('app.py', routes=[same_origin.route()])